@@ -1,11 +1,22 @@
+import hashlib
 import os
+from functools import lru_cache, wraps
 
-from flask import Flask, render_template, request, flash, redirect, session, g, url_for
+from flask import Flask, abort, render_template, request, flash, redirect, session, g, url_for, jsonify
+from flask_migrate import Migrate
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
 # from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 
+from cache import make_cache
 from forms import UserAddForm, LoginForm, MessageForm, EditProfileForm, ChangePasswordForm
-from models import db, connect_db, User, Message, Likes, Follows
+from hashing import hasher, HashingBusy
+from jobs import jobs
+from metrics import instrument
+from models import db, connect_db, User, UserProfile, Message, Likes, Follows, Timeline
+from pagination import decode_cursor, next_cursor
+from snowflake import snowflakes
 
 CURR_USER_KEY = "curr_user"
 
@@ -16,13 +27,116 @@ app = Flask(__name__, static_url_path='/static')
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgres:///warbler'))
 
+# Set DATABASE_REPLICA_URL to send queries made while serving GET requests to
+# a read replica; see replicas.py. After a POST, the browser's session stays
+# on the primary for REPLICA_STICKY_SECONDS so users see their own writes.
+app.config['SQLALCHEMY_BINDS'] = (
+    {'replica': os.environ['DATABASE_REPLICA_URL']} if os.environ.get('DATABASE_REPLICA_URL') else {})
+app.config['REPLICA_STICKY_SECONDS'] = int(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+
+# Connection pool settings, shared by the primary and the replica. SQLite
+# doesn't pool connections, so only pre-ping and recycle apply there.
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') != '0',
+    'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+}
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update(
+        pool_size=int(os.environ.get('DB_POOL_SIZE', 10)),
+        max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+        pool_timeout=int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+    )
+
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 # app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Authors with more followers than this are not fanned out to timelines when
+# they post; their messages are merged into the homepage at read time instead.
+app.config['TIMELINE_FANOUT_LIMIT'] = int(os.environ.get('TIMELINE_FANOUT_LIMIT', 10000))
+# How many of an author's latest messages are copied into a timeline on follow.
+app.config['TIMELINE_BACKFILL'] = int(os.environ.get('TIMELINE_BACKFILL', 100))
+app.config['MESSAGES_PER_PAGE'] = int(os.environ.get('MESSAGES_PER_PAGE', 100))
+app.config['USERS_PER_PAGE'] = int(os.environ.get('USERS_PER_PAGE', 30))
+app.config['MAX_LIKES_BATCH'] = int(os.environ.get('MAX_LIKES_BATCH', 100))
+
+# MESSAGE_IDS=snowflake has the app make time-ordered message ids, so feeds are
+# paged by id alone; see snowflake.py. Every process serving at the same time,
+# on any host, must be given its own SNOWFLAKE_WORKER_ID (0-63); two sharing
+# one would hand out the same ids, so there is no default.
+app.config['MESSAGE_IDS'] = os.environ.get('MESSAGE_IDS', 'serial')
+app.config['SNOWFLAKE_WORKER_ID'] = (
+    int(os.environ['SNOWFLAKE_WORKER_ID']) if os.environ.get('SNOWFLAKE_WORKER_ID') else None)
+
+# Profiles for `g.user` are cached between requests: in-process by default, or
+# shared between workers when USER_CACHE_URL is a redis:// URL.
+app.config['USER_CACHE_URL'] = os.environ.get('USER_CACHE_URL')
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 300))
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 10000))
 # toolbar = DebugToolbarExtension(app)
 
+# bcrypt work factor (raising it rehashes passwords as users log in), and the
+# size of the hashing pool and its queue.
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['HASH_WORKERS'] = int(os.environ.get('HASH_WORKERS', 4))
+app.config['HASH_MAX_PENDING'] = int(os.environ.get('HASH_MAX_PENDING', 64))
+
+# Side effects of posting and deleting (timeline fan-out, search indexing) run
+# as jobs; see jobs.py. With JOB_WORKERS=0 they run inline. JOB_QUEUE=sql keeps
+# them in the jobs table, where `flask work-jobs` can also pick them up.
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 0))
+app.config['JOB_QUEUE'] = os.environ.get('JOB_QUEUE', 'memory')
+app.config['JOB_RETRIES'] = int(os.environ.get('JOB_RETRIES', 3))
+
+# Statements slower than this are logged with their query plan; see metrics.py.
+app.config['SLOW_QUERY_MS'] = int(os.environ.get('SLOW_QUERY_MS', 200))
+
+# Rendered template fragments (e.g. profile stats cards) are cached under keys
+# that include the row version, so stale entries are simply never read again.
+app.config['FRAGMENT_CACHE_URL'] = os.environ.get('FRAGMENT_CACHE_URL', app.config['USER_CACHE_URL'])
+app.config['FRAGMENT_CACHE_TTL'] = int(os.environ.get('FRAGMENT_CACHE_TTL', 3600))
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+# How long shared caches may keep pages rendered for anonymous visitors.
+app.config['PUBLIC_MAX_AGE'] = int(os.environ.get('PUBLIC_MAX_AGE', 60))
+# Part of every page ETag and fragment cache key, so a deploy that changes
+# the markup doesn't keep serving the old one. Defaults to a hash of the
+# templates and static files.
+app.config['BUILD_VERSION'] = os.environ.get('BUILD_VERSION')
+
+# Compiled templates are kept on disk here, so a fresh worker loads them
+# instead of compiling them again (`flask compile-templates` fills it ahead
+# of time). Set it to an empty string to turn the cache off. Jinja runs
+# whatever it finds there, so it lives in the app's own instance folder,
+# never in a shared directory like /tmp that other users could write to.
+app.config['TEMPLATE_CACHE_DIR'] = os.environ.get(
+    'TEMPLATE_CACHE_DIR', os.path.join(app.instance_path, 'templates'))
+
+if app.config['TEMPLATE_CACHE_DIR']:
+    os.makedirs(app.config['TEMPLATE_CACHE_DIR'], mode=0o700, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['TEMPLATE_CACHE_DIR'])
+
 connect_db(app)
+# Schema changes are Alembic revisions in migrations/; see `flask db --help`.
+migrate = Migrate(app, db)
+instrument(app)
+hasher.configure(rounds=app.config['BCRYPT_LOG_ROUNDS'],
+                 workers=app.config['HASH_WORKERS'],
+                 max_pending=app.config['HASH_MAX_PENDING'])
+
+snowflakes.configure(enabled=app.config['MESSAGE_IDS'] == 'snowflake',
+                     worker_id=app.config['SNOWFLAKE_WORKER_ID'])
+
+jobs.configure(app, workers=app.config['JOB_WORKERS'],
+               durable=app.config['JOB_QUEUE'] == 'sql',
+               retries=app.config['JOB_RETRIES'])
+
+user_cache = make_cache(app.config['USER_CACHE_URL'],
+                        maxsize=app.config['USER_CACHE_SIZE'],
+                        ttl=app.config['USER_CACHE_TTL'])
+fragment_cache = make_cache(app.config['FRAGMENT_CACHE_URL'],
+                            maxsize=app.config['FRAGMENT_CACHE_SIZE'],
+                            ttl=app.config['FRAGMENT_CACHE_TTL'])
 
 
 
@@ -37,18 +151,45 @@ def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = load_user_profile(session[CURR_USER_KEY])
 
     else:
         g.user = None
 
 
+def load_user_profile(user_id):
+    """Profile for `user_id` from the user cache, falling back to the database."""
+
+    key = f"user:{user_id}"
+    fields = user_cache.get(key)
+    if fields is None:
+        fields = User.get_profile_fields(user_id)
+        if fields is None:
+            return None
+        user_cache.set(key, fields)
+    return UserProfile(**fields)
+
+
+def forget_user_profile(user_id):
+    """Drop a cached profile after the user row changes."""
+
+    user_cache.delete(f"user:{user_id}")
+
+
 def do_login(user):
     """Log in user."""
 
     session[CURR_USER_KEY] = user.id
 
 
+def followed_among(users):
+    """Set of ids in `users` the current user follows, loaded in one query."""
+
+    if not g.user:
+        return set()
+    return User.get_following_ids(g.user.id, [user.id for user in users])
+
+
 def do_logout():
     """Logout user."""
 
@@ -56,15 +197,18 @@ def do_logout():
         del session[CURR_USER_KEY]
     
 def authorize(f):
-    def unauth():
-        flash("Access unauthorized.", "danger")
-        return render_template("home-anon.html")
+    """Answer requests without a logged-in user with a 401 JSON error.
+
+    Only guards the JSON and javascript endpoints, where it goes below
+    `@app.route` so the route registers the wrapped view. Above a route,
+    as on the older HTML views, it does nothing.
+    """
+    @wraps(f)
     def wrapper(*args, **kwargs):
-        f(*args, **kwargs)
-    if g:
-        return wrapper
-    else:
-        return unauth
+        if not g.user:
+            return jsonify(error="Login required"), 401
+        return f(*args, **kwargs)
+    return wrapper
         
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
@@ -111,6 +255,7 @@ def login():
                                  form.password.data)
 
         if user:
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -139,13 +284,19 @@ def list_users():
     Can take a 'q' param in querystring to search by that username.
     """
     search = request.args.get('q')
+    per_page = app.config['USERS_PER_PAGE']
 
     if not search:
-        users = User.query.all()
+        after = request.args.get('after', type=int)
+        users, has_more = User.list_page(after=after, per_page=per_page)
+        next_url = url_for('list_users', after=users[-1].id) if has_more else None
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        page = max(request.args.get('page', 1, type=int), 1)
+        users, has_more = User.search(search, page=page, per_page=per_page)
+        next_url = url_for('list_users', q=search, page=page + 1) if has_more else None
 
-    return render_template('users/index.html', users=users)
+    return render_template('users/index.html', users=users, following=followed_among(users),
+                           next_url=next_url)
 
 @authorize
 @app.route('/users/<int:user_id>')
@@ -153,8 +304,16 @@ def users_show(user_id):
     """Show user profile."""
 
     user = User.query.get_or_404(user_id)
-    messages = Message.get_filtered_messages([user_id])
-    return render_template('users/show.html', user=user, messages=messages)
+    not_modified = conditional_page(user)
+    if not_modified:
+        return not_modified
+
+    per_page = app.config['MESSAGES_PER_PAGE']
+    before = decode_cursor(request.args.get('before'))
+    messages = Message.get_filtered_messages([user_id], before=before, limit=per_page,
+                                             viewer_id=g.user.id if g.user else None)
+    return render_template('users/show.html', user=user, messages=messages,
+                           next_page=next_cursor(messages, per_page))
 
 @authorize
 @app.route('/users/<int:user_id>/following')
@@ -162,8 +321,9 @@ def show_following(user_id):
     """Show list of people this user is following."""
 
     user = User.query.get_or_404(user_id)
-     
-    return render_template('users/associates.html', user=user, associates=user.following)
+    associates = user.following
+    return render_template('users/associates.html', user=user, associates=associates,
+                           following=followed_among(associates))
 
 @authorize
 @app.route('/users/<int:user_id>/followers')
@@ -171,15 +331,23 @@ def users_followers(user_id):
     """Show list of followers of this user."""
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/associates.html', user=user, associates=user.followers)
+    associates = user.followers
+    return render_template('users/associates.html', user=user, associates=associates,
+                           following=followed_among(associates))
 
 @authorize
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
     """Add a user to the following relationship for the currently-logged-in user."""
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    User.query.get_or_404(follow_id)
+    if follow_id == g.user.id:
+        flash("You can't follow yourself.", "danger")
+        return redirect(f"/users/{g.user.id}")
+    Follows.add_follow(g.user.id, follow_id)
+    db.session.flush()
+    if not Timeline.is_celebrity(follow_id, app.config['TIMELINE_FANOUT_LIMIT']):
+        Timeline.backfill(g.user.id, follow_id, app.config['TIMELINE_BACKFILL'])
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -189,8 +357,8 @@ def add_follow(follow_id):
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    Follows.delete_follow(g.user.id, follow_id)
+    Timeline.prune(g.user.id, follow_id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -199,10 +367,13 @@ def stop_following(follow_id):
 @app.route("/users/<int:user_id>/likes", methods=["GET"])
 def show_likes_page(user_id):
     """Show user likes page"""
-    liked = [x.id for x in g.user.likes if x.user_id != g.user.id]
-    messages = Message.get_liked_messages(liked)
-    likes = [x.id for x in g.user.likes if x.id != g.user.id]
-    return render_template('users/likes.html', user=g.user, messages=messages, likes=likes)
+    user = User.query.get_or_404(user_id)
+    per_page = app.config['MESSAGES_PER_PAGE']
+    before = decode_cursor(request.args.get('before'))
+    messages = Message.get_liked_by(user_id, before=before, limit=per_page,
+                                    viewer_id=g.user.id if g.user else None)
+    return render_template('users/likes.html', user=user, messages=messages,
+                           next_page=next_cursor(messages, per_page))
 
 @authorize
 @app.route('/users/profile', methods=["GET", "POST"])
@@ -219,6 +390,7 @@ def update_profile():
             if user:
                 User.update_user(user.id, form.email.data, form.image_url.data, form.header_image_url.data, form.bio.data, form.location.data)
                 db.session.commit()
+                forget_user_profile(user.id)
             else:
                 flash("Error, please recheck your info", 'danger')
         except IntegrityError:
@@ -244,6 +416,7 @@ def changepw():
             if user:
                 User.change_password(g.user.id, form.newPassword1.data)
                 db.session.commit()
+                forget_user_profile(g.user.id)
             else:
                 flash("Error, please recheck your info", 'danger')
         except IntegrityError:
@@ -261,8 +434,11 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    User.release_counters(g.user.id)
+    db.session.delete(User.query.get(g.user.id))
     db.session.commit()
+    forget_user_profile(g.user.id)
+    jobs.enqueue('prune_search_index')
 
     return redirect("/signup")
 
@@ -279,19 +455,50 @@ def messages_add():
     """
     form = MessageForm()
     if form.validate_on_submit():
-        message = Message(text=form.text.data)
-        g.user.messages.append(message)
+        message = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(message)
+        User.adjust_counters(g.user.id, messages_count=1)
         db.session.commit()
+        jobs.enqueue('deliver_message', key=f"deliver:{message.id}", message_id=message.id)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
+@authorize
+@app.route('/messages/search', methods=["GET"])
+def messages_search():
+    """Full-text search over messages.
+
+    Takes 'q' for the words to find, an optional 'user' id to search one
+    author's messages, and a 'before' cursor for older results.
+    """
+    search = request.args.get('q', '').strip()
+    author_id = request.args.get('user', type=int)
+    per_page = app.config['MESSAGES_PER_PAGE']
+    messages = []
+    next_page = None
+
+    if search:
+        before = decode_cursor(request.args.get('before'))
+        messages = Message.search(search, user_id=author_id, before=before, limit=per_page,
+                                  viewer_id=g.user.id if g.user else None)
+        next_page = next_cursor(messages, per_page)
+
+    return render_template('messages/search.html', messages=messages, search=search,
+                           author_id=author_id, next_page=next_page)
+
 @authorize
 @app.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""    
     message = Message.get_message_by_id(message_id)
+    if message is None:
+        abort(404)
+    not_modified = conditional_page(message.user, message.id)
+    if not_modified:
+        return not_modified
+
     return render_template('messages/show.html', message=message)
 
 @authorize
@@ -301,21 +508,181 @@ def messages_destroy(message_id):
    
     Message.delete_message(message_id)
     db.session.commit()
+    jobs.enqueue('forget_message', key=f"forget:{message_id}", message_id=message_id)
 
     return redirect(f"/users/{g.user.id}")
 
-@authorize
 @app.route("/do_like", methods=["POST"])
+@authorize
 def do_like():
     """Handle likes from javascript"""    
-    message_id = request.form["message_id"]    
-    if int(message_id) in [x.id for x in g.user.likes]:        
-        Likes.delete_like(g.user.id, message_id)
-    else:
-        Likes.add_like(g.user.id, message_id)        
-    db.session.commit()
+    message_id = request.form.get("message_id", type=int)
+    if message_id is None:
+        return jsonify(error="message_id must be an integer"), 400
+    try:
+        Likes.toggle_like(g.user.id, message_id)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify(error="No such message"), 404
     return 'None'
+
+@app.route("/messages/<int:message_id>/like", methods=["POST"])
+@authorize
+def like_message(message_id):
+    """Like a message. Liking an already liked message changes nothing."""
+    try:
+        Likes.add_like(g.user.id, message_id)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify(error="No such message"), 404
+    return jsonify(message_id=message_id, liked=True)
+
+@app.route("/messages/<int:message_id>/unlike", methods=["POST"])
+@authorize
+def unlike_message(message_id):
+    """Unlike a message. Unliking a message that isn't liked changes nothing."""
+    Likes.delete_like(g.user.id, message_id)
+    db.session.commit()
+    return jsonify(message_id=message_id, liked=False)
+
+@app.route("/likes/batch", methods=["POST"])
+@authorize
+def batch_likes():
+    """Apply a batch of like states from javascript in one request.
+
+    Takes JSON like {"likes": {"12": true, "15": false}}, mapping message ids
+    to whether they should end up liked, and returns the same shape, plus
+    the ids of messages that no longer exist under "skipped".
+    """
+    body = request.get_json(silent=True) or {}
+    states = (body.get('likes') or {}) if isinstance(body, dict) else None
+    if not isinstance(states, dict):
+        return jsonify(error="Expected {\"likes\": {message id: true or false}}"), 400
+    if len(states) > app.config['MAX_LIKES_BATCH']:
+        return jsonify(error="Too many likes in one batch"), 400
+    try:
+        states = {int(message_id): bool(liked) for message_id, liked in states.items()}
+    except (TypeError, ValueError):
+        return jsonify(error="Message ids must be integers"), 400
+
+    existing = {id for (id,) in db.session.query(Message.id).filter(Message.id.in_(states))}
+    skipped = sorted(set(states) - existing)
+    states = {message_id: liked for message_id, liked in states.items() if message_id in existing}
+    for message_id, liked in states.items():
+        if liked:
+            Likes.add_like(g.user.id, message_id)
+        else:
+            Likes.delete_like(g.user.id, message_id)
+    db.session.commit()
+    return jsonify(likes={str(message_id): liked for message_id, liked in states.items()}, skipped=skipped)
         
+##############################################################################
+# Background jobs
+
+
+@jobs.task('deliver_message')
+def deliver_message(message_id):
+    """Fan a new message out to timelines and index it for search."""
+
+    message = Message.query.get(message_id)
+    if message is None or Timeline.query.get((message.user_id, message_id)):
+        # Deleted since, or already delivered by an earlier run of this job.
+        return
+    Timeline.fan_out(message, app.config['TIMELINE_FANOUT_LIMIT'])
+    Message.add_to_search_index(message)
+
+
+@jobs.task('forget_message')
+def forget_message(message_id):
+    """Drop a deleted message from the search index."""
+
+    Message.remove_from_search_index(message_id)
+
+
+@jobs.task('prune_search_index')
+def prune_search_index():
+    """Drop search entries for messages removed along with their author."""
+
+    Message.prune_search_index()
+
+
+@app.cli.command('work-jobs')
+def work_jobs():
+    """Run queued jobs from the jobs table until none are left."""
+
+    print(f"ran {jobs.work()} jobs")
+
+
+##############################################################################
+# JSON API
+#
+# Compact, cursor-paginated versions of the read pages, built from timeline
+# rows rather than ORM objects. Pass the `next` cursor back as `before` to
+# get the following page.
+
+
+def message_json(row):
+    return {
+        'id': row.id,
+        'text': row.text,
+        'timestamp': row.timestamp.isoformat(),
+        'user': {'id': row.user_id, 'username': row.username, 'image_url': row.image_url},
+        'like_count': row.like_count,
+        'liked': bool(row.liked),
+    }
+
+
+def messages_page_json(messages, limit):
+    return {'messages': [message_json(row) for row in messages], 'next': next_cursor(messages, limit)}
+
+
+def api_page_size():
+    """Page size from the 'limit' query parameter, capped at MESSAGES_PER_PAGE."""
+
+    per_page = app.config['MESSAGES_PER_PAGE']
+    return min(max(request.args.get('limit', per_page, type=int), 1), per_page)
+
+
+@app.route('/api/v1/timeline')
+def api_timeline():
+    """The logged-in user's home timeline."""
+
+    if not g.user:
+        return jsonify(error="Login required"), 401
+
+    limit = api_page_size()
+    before = decode_cursor(request.args.get('before'))
+    messages = Timeline.get_home_messages(g.user.id, app.config['TIMELINE_FANOUT_LIMIT'],
+                                          before=before, limit=limit)
+    return jsonify(messages_page_json(messages, limit))
+
+
+@app.route('/api/v1/users/<int:user_id>')
+def api_user(user_id):
+    """A user's public profile and counters, with a page of their messages."""
+
+    profile = User.get_public_profile(user_id)
+    if profile is None:
+        return jsonify(error="No such user"), 404
+
+    limit = api_page_size()
+    before = decode_cursor(request.args.get('before'))
+    messages = Message.get_filtered_messages([user_id], before=before, limit=limit,
+                                             viewer_id=g.user.id if g.user else None)
+    return jsonify(user=profile, **messages_page_json(messages, limit))
+
+
+@app.route('/api/v1/messages/<int:message_id>')
+def api_message(message_id):
+    """A single message."""
+
+    row = Message.get_row(message_id, viewer_id=g.user.id if g.user else None)
+    if row is None:
+        return jsonify(error="No such message"), 404
+    return jsonify(message=message_json(row))
+
 ##############################################################################
 # Homepage and error pages
 
@@ -326,33 +693,168 @@ def homepage():
     The homepage for logged-in-users should show the last 100 warbles only from the users that the logged-in user is following, and that user, rather than warbles from all users.
     """
     if g.user:
-        messages = Message.get_filtered_messages([y.id for y in g.user.following])        
-        likes = [x.id for x in g.user.likes if x.id != g.user.id]
-        return render_template('home.html', messages=messages, likes=likes)
+        per_page = app.config['MESSAGES_PER_PAGE']
+        before = decode_cursor(request.args.get('before'))
+        messages = Timeline.get_home_messages(g.user.id, app.config['TIMELINE_FANOUT_LIMIT'],
+                                              before=before, limit=per_page)
+        return render_template('home.html', messages=messages, stats=User.get_stats(g.user.id),
+                               next_page=next_cursor(messages, per_page))
     else:
+        not_modified = conditional_page()
+        if not_modified:
+            return not_modified
         return render_template("home-anon.html")
 
+@app.cli.command('compile-templates')
+def compile_templates():
+    """Compile every template into the bytecode cache."""
+
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+
+@app.cli.command('repair-counters')
+def repair_counters():
+    """Recompute the denormalized user counters from scratch."""
+
+    User.recompute_counters()
+    db.session.commit()
+
+
+@app.errorhandler(HashingBusy)
+def hashing_busy(error):
+    return "Warbler is busy, please try again in a moment.", 503, {'Retry-After': '1'}
+
 @app.errorhandler(404)
 def page_not_found(error):
     return render_template("messages/page404.html", title = '404'), 404
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# HTTP caching
 #
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Static files are linked with a content hash in the URL (see `static_url`), so
+# they can be cached forever. Pages that call `conditional_page` get a weak
+# ETag built from the build version and the versions of the rows they show,
+# and answer matching conditional GETs with a 304 before doing any rendering.
+# Everything else, including every page with a form on it, is not stored.
 
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
 
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+@lru_cache(maxsize=None)
+def static_hash(path, mtime):
+    with open(path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()[:12]
+
+
+@app.template_global()
+def static_url(filename):
+    """URL for a static file that changes whenever the file's contents do."""
+
+    path = os.path.join(app.static_folder, filename)
+    return url_for('static', filename=filename, v=static_hash(path, os.stat(path).st_mtime))
+
+
+@lru_cache(maxsize=None)
+def files_hash(*folders):
+    md5 = hashlib.md5()
+    for folder in folders:
+        for root, dirs, files in sorted(os.walk(folder)):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                md5.update(os.path.relpath(path, folder).encode())
+                with open(path, 'rb') as f:
+                    md5.update(f.read())
+    return md5.hexdigest()[:12]
+
+
+def build_version():
+    """`BUILD_VERSION`, or a hash of everything a page is rendered from besides the database."""
+
+    return app.config['BUILD_VERSION'] or files_hash(
+        os.path.join(app.root_path, app.template_folder), app.static_folder)
+
+
+@lru_cache(maxsize=4096)
+def format_day(day):
+    return day.strftime('%d %B %Y')
+
+
+@app.template_filter('date')
+def date_filter(timestamp):
+    """Format a timestamp as e.g. "05 March 2020"; feeds repeat the same few days."""
+
+    return format_day(timestamp.date())
 
 
+@app.template_global()
+def cached_fragment(template_name, key, **context):
+    """Render `template_name` with `context`, cached under `key`.
 
-        
\ No newline at end of file
+    `key` must change whenever the output would, e.g. by including the
+    version of every row the fragment shows.
+    """
+
+    key = f"fragment:{build_version()}:{template_name}:{key}"
+    html = fragment_cache.get(key)
+    if html is None:
+        html = render_template(template_name, **context)
+        fragment_cache.set(key, html)
+    return Markup(html)
+
+
+def conditional_page(*parts):
+    """Tag this page with a weak ETag; a 304 response if the client has it already.
+
+    `parts` are the `User` rows (by version) and ids the page is built from;
+    the build version covers the templates and static files.
+    The viewer's own version is always included, since it changes with
+    everything that personalizes a page: their likes, follows and profile.
+    Returns None when the page has to be rendered.
+    """
+
+    if session.get('_flashes'):
+        return None
+
+    users = [part for part in parts if isinstance(part, User)]
+    versions = User.get_versions(*[user.id for user in users], *([g.user.id] if g.user else []))
+    tag = [build_version(), request.endpoint, g.user.id if g.user else None]
+    tag += [f"{part.id}.{versions.get(part.id)}" if isinstance(part, User) else part for part in parts]
+    if g.user:
+        tag.append(versions.get(g.user.id))
+    g.etag = hashlib.sha1(repr(tag).encode()).hexdigest()
+
+    if request.if_none_match.contains_weak(g.etag):
+        return app.response_class(status=304)
+    return None
+
+
+@app.after_request
+def add_header(response):
+    """Add caching headers on every request."""
+
+    if request.endpoint == 'static':
+        if 'v' in request.args:
+            response.cache_control.public = True
+            response.cache_control.max_age = 31536000
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+        return response
+
+    etag = g.get('etag')
+    if etag and response.status_code in (200, 304) and not session.modified:
+        response.set_etag(etag, weak=True)
+        if g.user:
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+        else:
+            response.cache_control.public = True
+            response.cache_control.max_age = app.config['PUBLIC_MAX_AGE']
+    else:
+        response.cache_control.no_store = True
+        response.cache_control.no_cache = True
+        response.cache_control.must_revalidate = True
+        response.headers["Pragma"] = "no-cache"
+        response.headers["Expires"] = "0"
+    response.vary.add('Cookie')
+    return response
@@ -0,0 +1,247 @@
+"""Benchmark Warbler's hot paths.
+
+Seeds a database with the CSV generator and loader, then times the routes
+users hit most, as a logged-in user, through the Flask test client (the
+default) or a local WSGI server (--wsgi, to include HTTP overhead):
+
+    python benchmarks/hot_paths.py --users 2000 --messages 50000 --follows 40000
+    python benchmarks/hot_paths.py --reuse --out after.json --compare before.json
+
+For each route it reports p50/p95/p99 latency, requests per second and SQL
+statements per request (from the Server-Timing header). Results are written
+as JSON, so runs from two commits can be diffed. With --compare, the run
+fails if a route's p95 got more than --threshold percent slower.
+"""
+
+import argparse
+import http.cookiejar
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+QUERIES = re.compile(r'desc="(\d+) queries"')
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+
+    if not sorted_values:
+        return None
+    rank = max(int(round(pct / 100 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def seed(args):
+    """Generate a dataset with the CSV generator and bulk-load it."""
+
+    from loader import load
+
+    with tempfile.TemporaryDirectory() as out:
+        subprocess.run([
+            sys.executable, os.path.join(ROOT, 'generator', 'create_csvs.py'),
+            '--users', str(args.users), '--messages', str(args.messages), '--follows', str(args.follows),
+            '--seed', args.seed, '--end', '2020-01-01', '--processes', str(args.processes), '--out', out,
+        ], check=True)
+        load(out)
+
+
+class TestClient:
+    """Requests through Flask's test client, in this process."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        resp = self.client.open(path, method=method, data=data)
+        resp.close()
+        return resp.status_code, resp.headers
+
+
+class HTTPClient:
+    """Requests over HTTP to a WSGI server started in this process."""
+
+    def __init__(self, app):
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        self.server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f"http://127.0.0.1:{self.server.server_port}"
+
+        class NoRedirects(urllib.request.HTTPRedirectHandler):
+            def redirect_request(self, *args, **kwargs):
+                return None
+
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirects())
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        req = urllib.request.Request(self.base + path, data=body, method=method)
+        try:
+            with self.opener.open(req) as resp:
+                resp.read()
+                return resp.status, resp.headers
+        except urllib.error.HTTPError as error:
+            return error.code, error.headers
+
+
+def routes(user_id, username, user_ids, message_ids, rng):
+    """(name, method, path-or-callable, data-callable) for each benchmarked route."""
+
+    return [
+        ('home', 'GET', lambda: '/', None),
+        ('users', 'GET', lambda: '/users', None),
+        ('users_show', 'GET', lambda: f"/users/{rng.choice(user_ids)}", None),
+        ('do_like', 'POST', lambda: '/do_like', lambda: {'message_id': rng.choice(message_ids)}),
+        ('messages_new', 'POST', lambda: '/messages/new', lambda: {'text': f"Benchmark {rng.random()}"}),
+        ('login', 'POST', lambda: '/login', lambda: {'username': username, 'password': 'password'}),
+    ]
+
+
+def run(client, method, path, data, count, warmup):
+    for _ in range(warmup):
+        client.request(method, path(), data() if data else None)
+
+    latencies = []
+    queries = []
+    errors = 0
+    start = time.perf_counter()
+    for _ in range(count):
+        t0 = time.perf_counter()
+        status, headers = client.request(method, path(), data() if data else None)
+        latencies.append(time.perf_counter() - t0)
+        if status >= 400:
+            errors += 1
+        match = QUERIES.search(headers.get('Server-Timing', ''))
+        if match:
+            queries.append(int(match.group(1)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': count,
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'mean_ms': round(sum(latencies) / count * 1000, 2),
+        'requests_per_second': round(count / elapsed, 1),
+        'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Print p95 changes against `baseline`; returns the routes that regressed."""
+
+    regressed = []
+    if (results['client'], results['database']) != (baseline.get('client'), baseline.get('database')):
+        print("warning: the baseline used a different client or database; timings are not comparable")
+    print(f"{'route':<14}{'p95 before':>12}{'p95 after':>12}{'change':>9}{'queries':>16}")
+    for name, after in results['routes'].items():
+        before = baseline['routes'].get(name)
+        if not before:
+            continue
+        change = (after['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100 if before['p95_ms'] else 0
+        queries = f"{before['queries_per_request']} -> {after['queries_per_request']}"
+        print(f"{name:<14}{before['p95_ms']:>12}{after['p95_ms']:>12}{change:>8.1f}%{queries:>16}")
+        if change > threshold:
+            regressed.append(name)
+    return regressed
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default='sqlite:////tmp/warbler-bench.db', help="database URL to seed and use")
+    parser.add_argument('--reuse', action='store_true', help="skip seeding and use the existing database")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=20000)
+    parser.add_argument('--seed', default='warbler')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--requests', type=int, default=200, help="timed requests per route")
+    parser.add_argument('--login-requests', type=int, default=20, help="timed logins (bcrypt is slow on purpose)")
+    parser.add_argument('--warmup', type=int, default=5, help="untimed requests per route first")
+    parser.add_argument('--wsgi', action='store_true', help="go through a local WSGI server instead of the test client")
+    parser.add_argument('--out', default='benchmark.json', help="where to write the results")
+    parser.add_argument('--compare', help="earlier results to compare against")
+    parser.add_argument('--threshold', type=float, default=20.0, help="allowed p95 slowdown, in percent")
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.db
+    from app import app, CURR_USER_KEY
+    from models import db, User, Message
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        if not args.reuse:
+            seed(args)
+        rng = random.Random(args.seed)
+        user_ids = [id for (id,) in db.session.query(User.id)]
+        message_ids = [id for (id,) in db.session.query(Message.id).limit(10000)]
+        # The busiest reader: whoever follows the most accounts.
+        user = User.query.order_by(User.following_count.desc()).first()
+        user_id, username = user.id, user.username
+        db.session.remove()
+
+    if args.wsgi:
+        client = HTTPClient(app)
+        client.request('POST', '/login', {'username': username, 'password': 'password'})
+    else:
+        client = TestClient(app)
+        with client.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'database': args.db.split(':')[0],
+        'client': 'wsgi' if args.wsgi else 'test_client',
+        'dataset': dict(users=args.users, messages=args.messages, follows=args.follows, seed=args.seed),
+        'routes': {},
+    }
+    for name, method, path, data in routes(user_id, username, user_ids, message_ids, rng):
+        count = args.login_requests if name == 'login' else args.requests
+        results['routes'][name] = stats = run(client, method, path, data, count, args.warmup)
+        print(f"{name:<14} p50 {stats['p50_ms']:>8} ms  p95 {stats['p95_ms']:>8} ms  "
+              f"p99 {stats['p99_ms']:>8} ms  {stats['requests_per_second']:>8} req/s  "
+              f"{stats['queries_per_request']} queries/req")
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print(f"wrote {args.out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressed = compare(results, json.load(f), args.threshold)
+        if regressed:
+            print(f"p95 regressed more than {args.threshold}%: {', '.join(regressed)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
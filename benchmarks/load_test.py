@@ -0,0 +1,316 @@
+"""Load-test Warbler with concurrent simulated users.
+
+Each simulated user signs up through the real signup form (CSRF token and
+all), then loops over a weighted mix of actions until its stage ends:
+reading the homepage, viewing profiles, following, liking through /do_like,
+posting through /messages/new and logging out and back in through /login
+(which pays for a password hash, like signup). Concurrency ramps up through --stages,
+and every stage reports per-route throughput, error rate and a latency
+histogram, so the knee of the curve shows up as the stage where latency
+climbs while throughput stops growing.
+
+Point it at a running server, or have it start one on a free port:
+
+    python benchmarks/load_test.py --url http://127.0.0.1:5000
+    python benchmarks/load_test.py --serve waitress --threads 8 --db sqlite:////tmp/warbler-load.db
+    python benchmarks/load_test.py --serve gunicorn --workers 4 --db postgresql:///warbler_load
+
+--serve waitress and --serve gunicorn need that server installed (pip install
+waitress / gunicorn); --serve werkzeug uses Flask's development server. A
+database given with --db is created if its tables don't exist yet. Lower
+BCRYPT_LOG_ROUNDS in the environment if signups shouldn't dominate.
+Results are also written as JSON (--out).
+"""
+
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Upper bounds (milliseconds) of the latency histogram buckets.
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+DEFAULT_MIX = 'home=50,profile=20,like=15,follow=5,post=10,login=5'
+
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+MESSAGE_IDS = re.compile(r"doLike\('#like_icon\d+, (\d+)'\)")
+USER_IDS = re.compile(r'href="/users/(\d+)"')
+
+
+class RouteStats:
+    """Latency histogram and outcome counts for one route in one stage."""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.latencies = []
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+
+    def observe(self, ms, ok):
+        self.count += 1
+        self.total_ms += ms
+        self.latencies.append(ms)
+        if not ok:
+            self.errors += 1
+        for i, bound in enumerate(BUCKETS_MS):
+            if ms <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def summary(self, seconds):
+        latencies = sorted(self.latencies)
+
+        def pct(p):
+            return round(latencies[min(int(p / 100 * len(latencies)), len(latencies) - 1)], 1)
+
+        return {
+            'requests': self.count,
+            'requests_per_second': round(self.count / seconds, 1),
+            'error_rate': round(self.errors / self.count, 4) if self.count else 0,
+            'p50_ms': pct(50) if latencies else None,
+            'p95_ms': pct(95) if latencies else None,
+            'p99_ms': pct(99) if latencies else None,
+            'histogram_ms': dict(zip([str(bound) for bound in BUCKETS_MS] + ['+Inf'], self.buckets)),
+        }
+
+
+class Stage:
+    """Stats for every route during one concurrency level."""
+
+    def __init__(self, users):
+        self.users = users
+        self.routes = defaultdict(RouteStats)
+        self._lock = threading.Lock()
+
+    def observe(self, route, ms, ok):
+        with self._lock:
+            self.routes[route].observe(ms, ok)
+
+
+class Session:
+    """One simulated user, with their own cookies."""
+
+    def __init__(self, base, stage, rng):
+        self.base = base
+        self.stage = stage
+        self.rng = rng
+        self.user_ids = set()
+        self.message_ids = []
+        self.following = set()
+        self.user_id = None
+        self.name = None
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, route, path, data=None, redirects=False):
+        """Fetch `path` (following redirects) and time it under `route`; returns the body or None.
+
+        With `redirects`, a response that didn't redirect (such as a form
+        re-rendered with validation errors) counts as an error.
+        """
+
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        start = time.perf_counter()
+        try:
+            with self.opener.open(self.base + path, data=body, timeout=60) as resp:
+                html = resp.read().decode('utf-8', 'replace')
+                ok = not redirects or resp.geturl() != self.base + path
+        except (urllib.error.URLError, OSError):
+            html, ok = None, False
+        self.stage.observe(route, (time.perf_counter() - start) * 1000, ok)
+        if html:
+            self.user_ids.update(int(id) for id in USER_IDS.findall(html))
+            found = [int(id) for id in MESSAGE_IDS.findall(html)]
+            if found:
+                self.message_ids = found
+        return html
+
+    def form(self, route, path, fields):
+        """GET a form for its CSRF token, then POST `fields` to it."""
+
+        html = self.request(f"{route}_form", path)
+        match = CSRF_TOKEN.search(html or '')
+        if match:
+            fields = dict(fields, csrf_token=match.group(1))
+        return self.request(route, path, fields, redirects=True)
+
+    def signup(self, name):
+        self.name = name
+        self.form('signup', '/signup', {
+            'username': name, 'email': f"{name}@example.com", 'password': 'password', 'image_url': '',
+        })
+
+    def home(self):
+        html = self.request('home', '/')
+        if html and self.user_id is None:
+            # The first profile link on the homepage is the navbar's own one.
+            match = USER_IDS.search(html)
+            self.user_id = int(match.group(1)) if match else None
+            self.following.add(self.user_id)
+
+    def profile(self):
+        if self.user_ids:
+            self.request('profile', f"/users/{self.rng.choice(sorted(self.user_ids))}")
+
+    def follow(self):
+        candidates = sorted(self.user_ids - self.following)
+        if candidates:
+            user_id = self.rng.choice(candidates)
+            self.following.add(user_id)
+            self.request('follow', f"/users/follow/{user_id}", {})
+
+    def like(self):
+        if self.message_ids:
+            self.request('like', '/do_like', {'message_id': self.rng.choice(self.message_ids)})
+
+    def login(self):
+        self.request('logout', '/logout')
+        self.form('login', '/login', {'username': self.name, 'password': 'password'})
+
+    def post(self):
+        self.form('post', '/messages/new', {'text': f"Load test warble {self.rng.random():.6f}"})
+
+
+def simulate(base, stage, name, mix, deadline, seed):
+    rng = random.Random(seed)
+    session = Session(base, stage, rng)
+    session.signup(name)
+    session.home()
+    session.request('users', '/users')
+    actions, weights = zip(*mix.items())
+    while time.monotonic() < deadline:
+        getattr(session, rng.choices(actions, weights)[0])()
+
+
+def run_stage(base, users, seconds, mix, run_id, seed):
+    stage = Stage(users)
+    deadline = time.monotonic() + seconds
+    threads = [
+        threading.Thread(target=simulate, daemon=True,
+                         args=(base, stage, f"load{run_id}u{users}n{i}", mix, deadline, f"{seed}:{users}:{i}"))
+        for i in range(users)
+    ]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+    return {
+        'users': users,
+        'seconds': round(elapsed, 1),
+        'requests_per_second': round(sum(route.count for route in stage.routes.values()) / elapsed, 1),
+        'routes': {route: stats.summary(elapsed) for route, stats in sorted(stage.routes.items())},
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def serve(args):
+    """Start `app` under the chosen server in a subprocess; returns (process, base URL)."""
+
+    port = free_port()
+    if args.serve == 'waitress':
+        command = ['waitress-serve', f'--listen=127.0.0.1:{port}', f'--threads={args.threads}', 'app:app']
+    elif args.serve == 'gunicorn':
+        command = ['gunicorn', f'--bind=127.0.0.1:{port}', f'--workers={args.workers}',
+                   f'--threads={args.threads}', 'app:app']
+    else:
+        command = [sys.executable, '-c',
+                   f"from app import app; app.run(port={port}, threaded=True)"]
+
+    env = dict(os.environ)
+    if args.db:
+        env['DATABASE_URL'] = args.db
+        subprocess.run([sys.executable, '-c', "from models import db; from app import app; db.create_all()"],
+                       cwd=ROOT, env=env, check=True)
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    base = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(base + '/login', timeout=1).close()
+            return process, base
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise SystemExit(f"{args.serve} didn't start on port {port}")
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        action, weight = part.split('=')
+        if action not in ('home', 'profile', 'like', 'follow', 'post', 'login'):
+            raise argparse.ArgumentTypeError(f"unknown action {action!r}")
+        mix[action] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--url', help="base URL of a running Warbler")
+    target.add_argument('--serve', choices=('waitress', 'gunicorn', 'werkzeug'),
+                        help="start app.py under this server for the test")
+    parser.add_argument('--db', default='', help="DATABASE_URL for --serve")
+    parser.add_argument('--workers', type=int, default=2, help="gunicorn worker processes")
+    parser.add_argument('--threads', type=int, default=8, help="threads per server process")
+    parser.add_argument('--stages', default='1,2,4,8,16,32',
+                        help="comma-separated concurrent users per stage")
+    parser.add_argument('--stage-seconds', type=float, default=30)
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"action weights (default {DEFAULT_MIX})")
+    parser.add_argument('--seed', default='warbler')
+    parser.add_argument('--out', default='load_test.json', help="where to write the results")
+    args = parser.parse_args()
+
+    process = None
+    if args.serve:
+        process, base = serve(args)
+    else:
+        base = args.url.rstrip('/')
+
+    run_id = int(time.time())
+    results = {'target': args.serve or base, 'mix': args.mix, 'stages': []}
+    try:
+        for users in [int(users) for users in args.stages.split(',')]:
+            stage = run_stage(base, users, args.stage_seconds, args.mix, run_id, args.seed)
+            results['stages'].append(stage)
+            print(f"\n{users} users: {stage['requests_per_second']} req/s")
+            print(f"  {'route':<12}{'req/s':>8}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+            for route, stats in stage['routes'].items():
+                print(f"  {route:<12}{stats['requests_per_second']:>8}{stats['error_rate']:>8.1%}"
+                      f"{stats['p50_ms']:>9}{stats['p95_ms']:>9}{stats['p99_ms']:>9}")
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nwrote {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""Benchmark template compile, load and render times.
+
+Renders each page template with a representative context (fake rows, no
+database queries), and reports for each one:
+
+* compile: first render in a fresh Jinja environment with no bytecode cache,
+  which compiles the template and everything it extends or imports;
+* cached load: the same first render, with the compiled code read back from
+  a warm bytecode cache, which is what a fresh worker pays;
+* render p50/p95: later renders, once everything is loaded.
+
+    python benchmarks/templates.py
+    python benchmarks/templates.py --messages 100 --renders 500 --out templates.json
+
+Results are written as JSON (--out), so runs from two commits can be diffed.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from jinja2 import FileSystemBytecodeCache
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+class FakeUser:
+    """Just enough of a `User` row for the templates."""
+
+    def __init__(self, id):
+        self.id = id
+        self.username = f"warbler{id}"
+        self.image_url = "/static/images/default-pic.png"
+        self.header_image_url = "/static/images/warbler-hero.jpg"
+        self.bio = "Benchmarking, one warble at a time."
+        self.location = "Nowhere"
+        self.version = 1
+        self.messages_count = self.following_count = self.followers_count = self.likes_count = 100
+
+    def is_following(self, other):
+        return other.id % 2 == 0
+
+
+class FakeMessage:
+    """A timeline row as `Message.timeline_rows` returns it."""
+
+    def __init__(self, id, user, timestamp):
+        self.id = id
+        self.user = user
+        self.user_id = user.id
+        self.username = user.username
+        self.image_url = user.image_url
+        self.text = f"Warble number {id}, which is about as long as warbles tend to get."
+        self.timestamp = timestamp
+        self.like_count = id % 7
+        self.liked = id % 3 == 0
+
+
+def contexts(count):
+    """(template, context) for each benchmarked page, with `count` messages per list."""
+
+    viewer = FakeUser(1)
+    users = [FakeUser(id) for id in range(2, 32)]
+    start = datetime(2020, 1, 1)
+    messages = [FakeMessage(id, users[id % len(users)], start - timedelta(hours=id)) for id in range(count)]
+    feed = dict(messages=messages, next_page="cursor")
+    return viewer, [
+        ('home.html', dict(feed, stats=viewer)),
+        ('users/show.html', dict(feed, user=users[0])),
+        ('users/likes.html', dict(feed, user=users[0])),
+        ('messages/search.html', dict(feed, search="warble", author_id=None)),
+        ('messages/show.html', dict(message=messages[0])),
+        ('users/index.html', dict(users=users, following={user.id for user in users[::2]}, next_url=None)),
+        ('home-anon.html', {}),
+    ]
+
+
+def first_render(app, name, context, bytecode_cache):
+    """Milliseconds for a first render of `name` in a fresh environment."""
+
+    # An overlay shares the app's filters and globals but gets an empty template cache.
+    env = app.jinja_env.overlay(cache_size=400, bytecode_cache=bytecode_cache)
+    start = time.perf_counter()
+    env.get_template(name).render(context)
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=100, help="messages per list")
+    parser.add_argument('--renders', type=int, default=200, help="timed renders per template")
+    parser.add_argument('--out', default='templates.json', help="where to write the results")
+    args = parser.parse_args()
+
+    os.environ.setdefault('DATABASE_URL', 'sqlite://')
+    from flask import g
+    from app import app
+
+    viewer, pages = contexts(args.messages)
+    results = {'messages': args.messages, 'renders': args.renders, 'templates': {}}
+    with tempfile.TemporaryDirectory() as cache_dir, app.test_request_context('/'):
+        g.user = viewer
+        bytecode_cache = FileSystemBytecodeCache(cache_dir)
+        print(f"{'template':<22}{'compile ms':>12}{'cached load ms':>16}{'render p50':>12}{'render p95':>12}")
+        for name, context in pages:
+            compile_ms = first_render(app, name, context, None)
+            first_render(app, name, context, bytecode_cache)
+            cached_ms = first_render(app, name, context, bytecode_cache)
+
+            template = app.jinja_env.get_template(name)
+            latencies = []
+            for _ in range(args.renders):
+                start = time.perf_counter()
+                template.render(context)
+                latencies.append((time.perf_counter() - start) * 1000)
+            latencies.sort()
+
+            results['templates'][name] = stats = {
+                'compile_ms': round(compile_ms, 2),
+                'cached_load_ms': round(cached_ms, 2),
+                'render_p50_ms': round(latencies[len(latencies) // 2], 3),
+                'render_p95_ms': round(latencies[int(len(latencies) * 0.95) - 1], 3),
+            }
+            print(f"{name:<22}{stats['compile_ms']:>12}{stats['cached_load_ms']:>16}"
+                  f"{stats['render_p50_ms']:>12}{stats['render_p95_ms']:>12}")
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print(f"wrote {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,15 +2,29 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. to build a large
+dataset for load testing:
+
+    python generator/create_csvs.py --users 1000000 --messages 20000000 \\
+        --follows 50000000 --out /tmp/warbler-data --processes 8
+
+Rows are streamed to disk, so memory stays flat however big the dataset is.
+Follower counts and author activity follow a power law (a few accounts are
+followed by a large share of users), and messages are posted in bursts.
+Work is split into fixed-size shards, each with its own seed derived from
+--seed, so the output is identical for any number of --processes.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import random
+import shutil
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+
 from faker import Faker
-from helpers import get_random_datetime
+from helpers import zipf_cum_weights, sample_rank, rank_to_user_id, bursty_timestamps
 
 MAX_WARBLER_LENGTH = 140
 
@@ -22,9 +36,13 @@ NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
 
-fake = Faker()
+# Rows per shard; shards are the unit of work handed to each process.
+SHARD_SIZE = 50000
+
+# Every user's password is "password".
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-# Generate random profile image URLs to use for users
+# Random profile image URLs to use for users
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +50,138 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
-
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
-
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+# Header image URLs to use for users, kept offline in header_images.txt
+
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'header_images.txt')) as f:
+    header_image_urls = f.read().split()
+
+
+def shard_rng(args, table, shard):
+    """Independent, reproducible random streams for one shard of one table."""
+
+    rng = random.Random(f"{args.seed}:{table}:{shard}")
+    fake = Faker()
+    fake.seed_instance(rng.getrandbits(32))
+    return rng, fake
+
+
+def write_users(args, shard, path):
+    rng, fake = shard_rng(args, 'users', shard)
+    first = shard * SHARD_SIZE + 1
+    last = min(first + SHARD_SIZE, args.users + 1)
+
+    with open(path, 'w', newline='') as users_csv:
+        users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
+        for user_id in range(first, last):
+            # Ids are appended so usernames and emails stay unique at any scale.
+            username = f"{fake.user_name()}{user_id}"
+            users_writer.writerow(dict(
+                email=f"{username}@{fake.free_email_domain()}",
+                username=username,
+                image_url=rng.choice(image_urls),
+                password=PASSWORD_HASH,
+                bio=fake.sentence(),
+                header_image_url=rng.choice(header_image_urls),
+                location=fake.city()
+            ))
+
+
+def write_messages(args, shard, path):
+    rng, fake = shard_rng(args, 'messages', shard)
+    count = min(SHARD_SIZE, args.messages - shard * SHARD_SIZE)
+    activity = zipf_cum_weights(args.users, args.alpha)
+    end = datetime.strptime(args.end, '%Y-%m-%d')
+    start = end - timedelta(days=args.days)
+
+    with open(path, 'w', newline='') as messages_csv:
+        messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
+        while count > 0:
+            # One posting session: a burst of 1-10 messages by one author.
+            user_id = rank_to_user_id(sample_rank(rng, activity), args.users)
+            burst = min(count, 1 + int(rng.expovariate(1 / 2)), 10)
+            for timestamp in bursty_timestamps(rng, start, end, burst):
+                messages_writer.writerow(dict(
+                    text=fake.paragraph()[:MAX_WARBLER_LENGTH],
+                    timestamp=timestamp,
+                    user_id=user_id
+                ))
+            count -= burst
+
+
+def write_follows(args, shard, path):
+    rng, _ = shard_rng(args, 'follows', shard)
+    popularity = zipf_cum_weights(args.users, args.alpha)
+    mean_following = args.follows / args.users
+    first = shard * SHARD_SIZE + 1
+    last = min(first + SHARD_SIZE, args.users + 1)
+
+    with open(path, 'w', newline='') as follows_csv:
+        follows_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
+        for follower in range(first, last):
+            # Out-degrees are roughly exponential around the mean; in-degrees
+            # follow the Zipf popularity of whoever gets picked.
+            wanted = min(round(rng.expovariate(1 / mean_following)) if mean_following else 0, args.users - 1)
+            followed = set()
+            for _ in range(wanted * 4):
+                if len(followed) == wanted:
+                    break
+                user_id = rank_to_user_id(sample_rank(rng, popularity), args.users)
+                if user_id != follower:
+                    followed.add(user_id)
+            for user_id in sorted(followed):
+                follows_writer.writerow(dict(user_being_followed_id=user_id, user_following_id=follower))
+
+
+WRITERS = {
+    'users': (write_users, USERS_CSV_HEADERS, lambda args: args.users),
+    'messages': (write_messages, MESSAGES_CSV_HEADERS, lambda args: args.messages),
+    'follows': (write_follows, FOLLOWS_CSV_HEADERS, lambda args: args.users),
+}
+
+
+def write_shard(job):
+    args, table, shard = job
+    path = os.path.join(args.out, f"{table}.csv.{shard:05d}")
+    WRITERS[table][0](args, shard, path)
+    return path
+
+
+def generate(args):
+    os.makedirs(args.out, exist_ok=True)
+    jobs = [
+        (args, table, shard)
+        for table, (_, _, rows) in WRITERS.items()
+        for shard in range(-(-rows(args) // SHARD_SIZE))
+    ]
+
+    with Pool(args.processes) as pool:
+        parts = pool.map(write_shard, jobs, chunksize=1)
+
+    for table, (_, headers, _) in WRITERS.items():
+        with open(os.path.join(args.out, f"{table}.csv"), 'w', newline='') as out:
+            csv.DictWriter(out, fieldnames=headers).writeheader()
+            for path in parts:
+                if os.path.basename(path).startswith(f"{table}.csv."):
+                    with open(path, newline='') as part:
+                        shutil.copyfileobj(part, out)
+                    os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS, help="approximate number of follow edges")
+    parser.add_argument('--alpha', type=float, default=1.0,
+                        help="power-law exponent for follower counts and posting activity")
+    parser.add_argument('--end', default=datetime.utcnow().strftime('%Y-%m-%d'),
+                        help="latest message date, YYYY-MM-DD (set it for reproducible output)")
+    parser.add_argument('--days', type=int, default=730, help="how many days of messages to spread out")
+    parser.add_argument('--seed', default='warbler')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--out', default='generator', help="directory to write the CSVs to")
+    generate(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
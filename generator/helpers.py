@@ -1,6 +1,9 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from itertools import accumulate
+from math import gcd
 from random import uniform
 
 
@@ -12,3 +15,42 @@ def get_random_datetime(year_gap=2):
     random_timestamp = uniform(then.timestamp(), now.timestamp())
 
     return datetime.fromtimestamp(random_timestamp)
+
+
+def zipf_cum_weights(n, alpha):
+    """Cumulative Zipf weights for ranks 1..n: rank r has weight 1 / r**alpha."""
+
+    return list(accumulate(1 / rank ** alpha for rank in range(1, n + 1)))
+
+
+def sample_rank(rng, cum_weights):
+    """Draw a 0-based rank from `zipf_cum_weights` output in O(log n)."""
+
+    return bisect_left(cum_weights, rng.random() * cum_weights[-1])
+
+
+def rank_to_user_id(rank, num_users):
+    """Scatter popularity ranks over user ids so popular users aren't just ids 1, 2, 3...
+
+    Multiplying by a step coprime to `num_users` is a cheap bijection on
+    0..num_users-1, so no permutation table has to be held in memory.
+    """
+
+    step = 7919
+    while gcd(step, num_users) != 1:
+        step += 2
+    return (rank * step) % num_users + 1
+
+
+def bursty_timestamps(rng, start, end, count, mean_gap_minutes=6):
+    """`count` timestamps for one posting session.
+
+    The session starts at a uniformly random moment in [start, end) and the
+    posts follow each other with exponential gaps, so activity comes in
+    bursts rather than being spread evenly.
+    """
+
+    moment = start + timedelta(seconds=rng.uniform(0, (end - start).total_seconds()))
+    for _ in range(count):
+        yield moment
+        moment += timedelta(minutes=rng.expovariate(1 / mean_gap_minutes))
@@ -0,0 +1,121 @@
+"""Password hashing on a bounded worker pool.
+
+bcrypt is deliberately slow, so hashes run on a small dedicated thread pool
+(bcrypt releases the GIL while it works) instead of on whatever request
+thread asked for them. At most `max_pending` hashes may be queued or running
+at once; past that, callers get `HashingBusy` straight away rather than
+piling up behind a login storm. A hash that takes longer than `timeout`
+also raises `HashingBusy`, but keeps its slot until bcrypt actually finishes.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from flask_bcrypt import Bcrypt
+
+bcrypt = Bcrypt()
+
+# Upper bounds (seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class HashingBusy(Exception):
+    """Too many password hashes are already queued, or one took too long; try again shortly."""
+
+
+class HashMetrics:
+    """Running totals for hash latency, including time spent queued."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.rejected = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        # Called with each latency on the thread that asked for the hash.
+        self.listeners = []
+
+    def observe(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    self.buckets[i] += 1
+        for listener in self.listeners:
+            listener(seconds)
+
+    def reject(self):
+        with self._lock:
+            self.rejected += 1
+
+
+class PasswordHasher:
+    """Hashes and checks passwords on a bounded pool of worker threads."""
+
+    def __init__(self, rounds=12, workers=4, max_pending=64, timeout=30):
+        self.metrics = HashMetrics()
+        self.configure(rounds, workers, max_pending, timeout)
+
+    def configure(self, rounds, workers, max_pending, timeout=30):
+        """(Re)build the pool; call once at startup."""
+
+        self.rounds = rounds
+        self.timeout = timeout
+        self.pending = 0
+        self._pending_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_pending)
+        if getattr(self, '_executor', None):
+            self._executor.shutdown(wait=False)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            self.metrics.reject()
+            raise HashingBusy()
+
+        with self._pending_lock:
+            self.pending += 1
+        slots = self._slots
+        start = time.perf_counter()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._release(slots)
+            raise
+        # The slot is held until the work is done, not just until we stop waiting.
+        future.add_done_callback(lambda future: self._release(slots))
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            future.cancel()
+            raise HashingBusy() from None
+        finally:
+            self.metrics.observe(time.perf_counter() - start)
+
+    def _release(self, slots):
+        with self._pending_lock:
+            self.pending -= 1
+        slots.release()
+
+    def hash(self, password):
+        """bcrypt hash of `password` at the configured cost."""
+
+        return self._run(bcrypt.generate_password_hash, password, self.rounds).decode('UTF-8')
+
+    def check(self, pw_hash, password):
+        """Does `password` match `pw_hash`?"""
+
+        return self._run(bcrypt.check_password_hash, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        """Was `pw_hash` made with a different cost than the configured one?"""
+
+        # bcrypt hashes look like $2b$<cost>$<salt+hash>
+        return int(pw_hash.split('$')[2]) != self.rounds
+
+
+hasher = PasswordHasher()
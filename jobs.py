@@ -0,0 +1,234 @@
+"""Background jobs for work that doesn't have to finish before a response.
+
+Views commit their own changes, then `enqueue` the side effects, such as
+timeline fan-out and search indexing. There are three ways to run them:
+
+* inline (`workers=0`, the default): the job runs right away on the calling
+  thread, exactly as if the view had done the work itself. It gets one
+  attempt, so a failing job never keeps a request waiting on backoff;
+* in memory: jobs go on a queue drained by `workers` background threads, and
+  anything still queued when the process dies is lost;
+* durable (`durable=True`): jobs are rows in the `jobs` table, drained by the
+  worker threads and/or by `flask work-jobs` in another process, and they
+  survive restarts.
+
+Queued jobs are retried with exponential backoff. A job enqueued with a `key`
+that is already queued is dropped, so enqueueing is idempotent. Handlers
+should be too: after a crash, a durable job may run again.
+"""
+
+import atexit
+import json
+import logging
+import queue
+import threading
+import time
+from contextlib import nullcontext
+
+from flask import has_app_context
+
+from models import db, Job
+
+logger = logging.getLogger(__name__)
+
+
+class JobMetrics:
+    """Running totals for jobs; `running` is how many are in progress right now."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.enqueued = 0
+        self.duplicates = 0
+        self.succeeded = 0
+        self.retried = 0
+        self.failed = 0
+        self.running = 0
+
+    def add(self, **deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                setattr(self, name, getattr(self, name) + delta)
+
+
+class JobQueue:
+    """Runs registered handlers by name, inline or on background workers."""
+
+    def __init__(self):
+        self.handlers = {}
+        self.metrics = JobMetrics()
+        self.app = None
+        self.workers = 0
+        self.durable = False
+        self._threads = []
+        atexit.register(self.shutdown)
+
+    def task(self, name):
+        """Decorator registering a handler for jobs called `name`."""
+
+        def register(fn):
+            self.handlers[name] = fn
+            return fn
+        return register
+
+    def configure(self, app, workers=0, durable=False, retries=3, backoff=0.5,
+                  poll_interval=1.0, lease=300):
+        """Start the workers; call once at startup."""
+
+        self.shutdown()
+        self.app = app
+        self.workers = workers
+        self.durable = durable
+        self.retries = retries
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self._queued = set()
+        self._queued_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._stopping = threading.Event()
+        work = self._poll if durable else self._drain
+        self._threads = [threading.Thread(target=work, name=f'jobs-{i}', daemon=True) for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def shutdown(self):
+        """Let the workers finish what they have started, then stop them."""
+
+        if not self._threads:
+            return
+        self._stopping.set()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def enqueue(self, name, key=None, **payload):
+        """Run handler `name` with `payload` in the background.
+
+        Call it after committing whatever the job needs to read. Returns
+        False if a job with the same `key` was dropped as a duplicate.
+        """
+
+        if self.durable:
+            added = Job.push(name, key, json.dumps(payload))
+            db.session.commit()
+        else:
+            added = self._claim_key(key)
+        if not added:
+            self.metrics.add(duplicates=1)
+            return False
+
+        self.metrics.add(enqueued=1)
+        if not self.durable:
+            if self.workers:
+                self._queue.put((name, key, payload))
+            else:
+                self._run(name, key, payload)
+        return True
+
+    def depth(self):
+        """Number of jobs waiting to run."""
+
+        if self.durable:
+            with self._context():
+                return Job.depth()
+        return self._queue.qsize()
+
+    def stats(self):
+        metrics = self.metrics
+        return dict(depth=self.depth(), running=metrics.running, enqueued=metrics.enqueued,
+                    duplicates=metrics.duplicates, succeeded=metrics.succeeded,
+                    retried=metrics.retried, failed=metrics.failed)
+
+    def work(self):
+        """Run durable jobs on this thread until none are runnable; returns how many ran."""
+
+        ran = 0
+        with self._context():
+            while self._run_claimed(Job.claim(self.lease)):
+                ran += 1
+        return ran
+
+    def _claim_key(self, key):
+        if key is None:
+            return True
+        with self._queued_lock:
+            if key in self._queued:
+                return False
+            self._queued.add(key)
+        return True
+
+    def _context(self):
+        # Inline jobs share the caller's app context (and database session).
+        return nullcontext() if has_app_context() else self.app.app_context()
+
+    def _drain(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            self._run(*job)
+
+    def _poll(self):
+        while not self._stopping.is_set():
+            try:
+                ran = self.work()
+            except Exception:
+                logger.exception("job queue poll failed")
+                ran = 0
+            if not ran:
+                self._stopping.wait(self.poll_interval)
+
+    def _call(self, name, payload):
+        """Run one attempt of a job, committing its work; returns whether it succeeded."""
+
+        self.metrics.add(running=1)
+        try:
+            self.handlers[name](**payload)
+            db.session.commit()
+            return True
+        except Exception:
+            db.session.rollback()
+            logger.exception("job %s failed", name)
+            return False
+        finally:
+            self.metrics.add(running=-1)
+
+    def _run(self, name, key, payload):
+        try:
+            with self._context():
+                # Inline jobs run on the request thread: no retries, no sleeping.
+                attempts = self.retries + 1 if self.workers else 1
+                for attempt in range(attempts):
+                    if attempt:
+                        self.metrics.add(retried=1)
+                        time.sleep(self.backoff * 2 ** (attempt - 1))
+                    if self._call(name, payload):
+                        self.metrics.add(succeeded=1)
+                        return
+                self.metrics.add(failed=1)
+        finally:
+            with self._queued_lock:
+                self._queued.discard(key)
+
+    def _run_claimed(self, job):
+        """Run a job leased from the `jobs` table; returns False if there was none."""
+
+        if job is None:
+            return False
+        job_id, name, payload, attempts = job.id, job.name, json.loads(job.payload), job.attempts
+        if self._call(name, payload):
+            Job.query.filter_by(id=job_id).delete()
+            self.metrics.add(succeeded=1)
+        elif attempts > self.retries:
+            Job.bury(job_id)
+            self.metrics.add(failed=1)
+        else:
+            Job.retry(job_id, self.backoff * 2 ** (attempts - 1))
+            self.metrics.add(retried=1)
+        db.session.commit()
+        return True
+
+
+jobs = JobQueue()
@@ -0,0 +1,185 @@
+"""Bulk-load Warbler CSV files into the database.
+
+Postgres rows are streamed through `COPY ... FROM STDIN`; other databases get
+batched `executemany` inserts. Secondary indexes and foreign keys on the
+tables being loaded are dropped first and rebuilt once the rows are in,
+which is far cheaper than maintaining them row by row.
+
+    python loader.py                          # drop everything, load all CSVs
+    python loader.py --append --table follows # add rows to one table
+    python loader.py --dir /tmp/fixtures      # load CSVs from elsewhere
+"""
+
+import argparse
+import csv
+import os
+import time
+from contextlib import contextmanager
+
+from flask_migrate import stamp
+from sqlalchemy import func, select, text
+
+from app import app, db
+from models import User, Message, Timeline
+
+# Load order respects foreign keys even when they are not deferred.
+TABLES = ('users', 'messages', 'follows')
+
+MIGRATIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+
+def csv_columns(path):
+    with open(path, newline='') as f:
+        return next(csv.reader(f))
+
+
+def copy_csv(connection, table, path):
+    """Stream a CSV into `table` with Postgres COPY; returns the row count."""
+
+    columns = ', '.join(csv_columns(path))
+    cursor = connection.connection.cursor()
+    with open(path, newline='') as f:
+        cursor.copy_expert(f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv, HEADER true)", f)
+    return cursor.rowcount
+
+
+def insert_csv(connection, table, path, batch_size):
+    """Insert a CSV into `table` in batches of `batch_size` rows; returns the row count."""
+
+    columns = csv_columns(path)
+    insert = text(f"INSERT INTO {table} ({', '.join(columns)}) "
+                  f"VALUES ({', '.join(':' + column for column in columns)})")
+    rows = 0
+    with open(path, newline='') as f:
+        batch = []
+        for row in csv.DictReader(f):
+            batch.append({column: (value if value != '' else None) for column, value in row.items()})
+            if len(batch) >= batch_size:
+                connection.execute(insert, batch)
+                rows += len(batch)
+                batch = []
+        if batch:
+            connection.execute(insert, batch)
+            rows += len(batch)
+    return rows
+
+
+@contextmanager
+def deferred_indexes(connection, tables):
+    """Drop secondary indexes and foreign keys on `tables`, restoring them on exit.
+
+    Use it outside the load's transaction: the indexes come back even if the
+    load fails, and SQLite ignores `PRAGMA foreign_keys` inside transactions.
+    """
+
+    restore = []
+    if connection.dialect.name == 'postgresql':
+        for table in tables:
+            for name, definition in connection.execute(text(
+                    "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+                    "WHERE conrelid = CAST(:table AS regclass) AND contype = 'f'"), table=table).fetchall():
+                connection.execute(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"')
+                restore.append(f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}')
+            for name, definition in connection.execute(text(
+                    "SELECT i.relname, pg_get_indexdef(x.indexrelid) FROM pg_index x "
+                    "JOIN pg_class i ON i.oid = x.indexrelid "
+                    "WHERE x.indrelid = CAST(:table AS regclass) AND NOT x.indisprimary AND NOT x.indisunique"),
+                    table=table).fetchall():
+                connection.execute(f'DROP INDEX "{name}"')
+                restore.insert(0, definition)
+    elif connection.dialect.name == 'sqlite':
+        connection.execute("PRAGMA foreign_keys = OFF")
+        for table in tables:
+            for name, definition in connection.execute(text(
+                    "SELECT name, sql FROM sqlite_master "
+                    "WHERE type = 'index' AND tbl_name = :table AND sql IS NOT NULL"), table=table).fetchall():
+                connection.execute(f'DROP INDEX "{name}"')
+                restore.append(definition)
+
+    try:
+        yield
+    finally:
+        start = time.perf_counter()
+        for statement in restore:
+            connection.execute(statement)
+        if connection.dialect.name == 'sqlite':
+            connection.execute("PRAGMA foreign_keys = ON")
+        if restore:
+            print(f"rebuilt {len(restore)} indexes/constraints in {time.perf_counter() - start:.1f}s")
+
+
+def check_foreign_keys(connection, tables):
+    """Raise ValueError if rows in `tables` refer to rows that don't exist.
+
+    Foreign keys are off while loading, so this is where bad CSV rows are
+    caught, before the load's transaction commits.
+    """
+
+    for table in tables:
+        for fk in db.metadata.tables[table].foreign_keys:
+            child, parent = fk.parent, fk.column
+            missing = connection.execute(
+                select([func.count()])
+                .select_from(child.table.outerjoin(parent.table, child == parent))
+                .where(child.isnot(None) & parent.is_(None))
+            ).scalar()
+            if missing:
+                raise ValueError(f"{missing} rows in {table}.{child.name} refer to missing {parent.table.name} rows")
+
+
+def rebuild_derived():
+    """Recompute counters, search index and timelines from the loaded rows."""
+
+    start = time.perf_counter()
+    User.recompute_counters()
+    Message.rebuild_search_index()
+    Timeline.rebuild(app.config['TIMELINE_FANOUT_LIMIT'], app.config['TIMELINE_BACKFILL'])
+    db.session.commit()
+    print(f"rebuilt counters, search index and timelines in {time.perf_counter() - start:.1f}s")
+
+
+def load(directory='generator', tables=TABLES, append=False, batch_size=5000, derived=True):
+    """Load `<directory>/<table>.csv` for each table, optionally appending."""
+
+    if not append:
+        db.drop_all()
+        db.create_all()
+        # create_all() builds the newest schema; record that for `flask db upgrade`.
+        with app.app_context():
+            stamp(MIGRATIONS)
+
+    with db.engine.connect() as connection:
+        with deferred_indexes(connection, tables), connection.begin():
+            for table in TABLES:
+                if table not in tables:
+                    continue
+                path = os.path.join(directory, f"{table}.csv")
+                start = time.perf_counter()
+                if connection.dialect.name == 'postgresql':
+                    rows = copy_csv(connection, table, path)
+                else:
+                    rows = insert_csv(connection, table, path, batch_size)
+                elapsed = time.perf_counter() - start
+                print(f"{table}: {rows} rows in {elapsed:.1f}s ({rows / max(elapsed, 1e-9):,.0f} rows/s)")
+            check_foreign_keys(connection, [table for table in TABLES if table in tables])
+
+    if derived:
+        rebuild_derived()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', default='generator', help="directory holding <table>.csv files")
+    parser.add_argument('--table', action='append', choices=TABLES, help="load only this table (repeatable)")
+    parser.add_argument('--append', action='store_true', help="keep existing tables and rows")
+    parser.add_argument('--batch-size', type=int, default=5000, help="rows per executemany batch")
+    parser.add_argument('--no-derived', action='store_true',
+                        help="skip rebuilding counters, search index and timelines")
+    args = parser.parse_args()
+
+    load(args.dir, tables=args.table or TABLES, append=args.append,
+         batch_size=args.batch_size, derived=not args.no_derived)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+"""Per-request instrumentation: SQL, template and password hashing time.
+
+Every request gets a `RequestMetrics` on `g`, filled in by SQLAlchemy engine
+events, Flask's template signals and the password hasher. When the request
+ends the totals are
+
+* sent back in a `Server-Timing` header, so they show up in the browser's
+  network panel;
+* logged as one JSON line on the `warbler.requests` logger;
+* added to per-endpoint counters served in Prometheus text format at
+  `/_metrics`.
+
+Statements slower than `SLOW_QUERY_MS` are logged on `warbler.slow_queries`
+together with the database's plan for them.
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from flask import g, has_request_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from hashing import hasher
+from jobs import jobs
+
+request_log = logging.getLogger('warbler.requests')
+slow_query_log = logging.getLogger('warbler.slow_queries')
+
+# Upper bounds (seconds) of the request duration histogram buckets.
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+EXPLAIN_PREFIXES = {'postgresql': 'EXPLAIN ', 'sqlite': 'EXPLAIN QUERY PLAN '}
+
+
+class RequestMetrics:
+    """What one request has spent so far."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+        self.hash_seconds = 0.0
+        self._templates = []
+
+    def server_timing(self, total):
+        return ', '.join([
+            f'db;dur={self.sql_seconds * 1000:.1f};desc="{self.sql_count} queries"',
+            f'tpl;dur={self.template_seconds * 1000:.1f}',
+            f'hash;dur={self.hash_seconds * 1000:.1f}',
+            f'total;dur={total * 1000:.1f}',
+        ])
+
+
+class MetricsRegistry:
+    """Per-endpoint totals since the process started."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.buckets = defaultdict(lambda: [0] * len(DURATION_BUCKETS))
+        self.durations = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.sql_count = defaultdict(int)
+        self.sql_seconds = defaultdict(float)
+        self.template_seconds = defaultdict(float)
+        self.hash_seconds = defaultdict(float)
+        self.slow_queries = 0
+
+    def record(self, endpoint, status, total, metrics):
+        with self._lock:
+            self.requests[endpoint, status] += 1
+            self.counts[endpoint] += 1
+            self.durations[endpoint] += total
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if total <= bound:
+                    self.buckets[endpoint][i] += 1
+            self.sql_count[endpoint] += metrics.sql_count
+            self.sql_seconds[endpoint] += metrics.sql_seconds
+            self.template_seconds[endpoint] += metrics.template_seconds
+            self.hash_seconds[endpoint] += metrics.hash_seconds
+
+    def record_slow_query(self):
+        with self._lock:
+            self.slow_queries += 1
+
+    def prometheus(self):
+        """Everything in Prometheus text exposition format."""
+
+        lines = []
+
+        def family(name, kind, help, samples):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{val}"' for key, val in labels)
+                lines.append(f"{name}{{{label_text}}} {value}" if labels else f"{name} {value}")
+
+        with self._lock:
+            family('warbler_requests_total', 'counter', "Requests served.", [
+                ((('endpoint', endpoint), ('status', status)), count)
+                for (endpoint, status), count in sorted(self.requests.items())
+            ])
+
+            name = 'warbler_request_duration_seconds'
+            lines.append(f"# HELP {name} Request duration.")
+            lines.append(f"# TYPE {name} histogram")
+            for endpoint, buckets in sorted(self.buckets.items()):
+                for bound, count in zip(DURATION_BUCKETS, buckets):
+                    lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="+Inf"}} {self.counts[endpoint]}')
+                lines.append(f'{name}_sum{{endpoint="{endpoint}"}} {self.durations[endpoint]}')
+                lines.append(f'{name}_count{{endpoint="{endpoint}"}} {self.counts[endpoint]}')
+
+            for name, help, values in [
+                ('warbler_sql_statements_total', "SQL statements run by requests.", self.sql_count),
+                ('warbler_sql_seconds_total', "Time requests spent in the database.", self.sql_seconds),
+                ('warbler_template_seconds_total', "Time requests spent rendering templates.",
+                 self.template_seconds),
+                ('warbler_hash_seconds_total', "Time requests spent waiting on password hashes.",
+                 self.hash_seconds),
+            ]:
+                family(name, 'counter', help, [((('endpoint', endpoint),), value)
+                                               for endpoint, value in sorted(values.items())])
+
+            family('warbler_slow_queries_total', 'counter', "Statements over the slow query threshold.",
+                   [((), self.slow_queries)])
+
+        family('warbler_password_hashes_total', 'counter', "Password hashes and checks run.",
+               [((), hasher.metrics.count)])
+        family('warbler_password_hashes_rejected_total', 'counter', "Hashes refused because the pool was full.",
+               [((), hasher.metrics.rejected)])
+
+        stats = jobs.stats()
+        family('warbler_job_queue_depth', 'gauge', "Jobs waiting to run.", [((), stats['depth'])])
+        family('warbler_jobs_running', 'gauge', "Jobs running now.", [((), stats['running'])])
+        family('warbler_jobs_total', 'counter', "Jobs by outcome.", [
+            ((('outcome', outcome),), stats[outcome])
+            for outcome in ('enqueued', 'duplicates', 'succeeded', 'retried', 'failed')
+        ])
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+def current():
+    """The current request's metrics, or None outside requests."""
+
+    return g.get('metrics') if has_request_context() else None
+
+
+def explain(connection, statement, parameters):
+    """The database's plan for `statement`, as text; None if it can't be explained."""
+
+    dialect = connection.dialect.name
+    prefix = EXPLAIN_PREFIXES.get(dialect)
+    if prefix is None or not statement.lstrip().upper().startswith('SELECT'):
+        return None
+
+    # Runs on a raw cursor so it isn't instrumented itself. On Postgres a
+    # failed statement would abort the surrounding transaction, so the
+    # EXPLAIN gets a savepoint of its own.
+    cursor = connection.connection.cursor()
+    savepoint = dialect == 'postgresql'
+    try:
+        if savepoint:
+            cursor.execute("SAVEPOINT explain_slow_query")
+        cursor.execute(prefix + statement, parameters)
+        plan = '\n'.join(' '.join(str(column) for column in row) for row in cursor.fetchall())
+        if savepoint:
+            cursor.execute("RELEASE SAVEPOINT explain_slow_query")
+        return plan
+    except Exception as error:
+        if savepoint:
+            cursor.execute("ROLLBACK TO SAVEPOINT explain_slow_query")
+        return f"(EXPLAIN failed: {error})"
+    finally:
+        cursor.close()
+
+
+def instrument(app):
+    """Install the hooks, the `/_metrics` endpoint and the slow query log."""
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def start_statement(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('statement_start', []).append(time.perf_counter())
+
+    @event.listens_for(Engine, 'handle_error')
+    def fail_statement(context):
+        # after_cursor_execute never runs for a statement that raised.
+        if context.connection is not None and context.execution_context is not None:
+            starts = context.connection.info.get('statement_start')
+            if starts:
+                starts.pop()
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def end_statement(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['statement_start'].pop()
+        metrics = current()
+        if metrics:
+            metrics.sql_count += 1
+            metrics.sql_seconds += elapsed
+
+        if elapsed * 1000 >= app.config['SLOW_QUERY_MS']:
+            registry.record_slow_query()
+            plan = None if executemany else explain(conn, statement, parameters)
+            slow_query_log.warning(json.dumps(dict(
+                ms=round(elapsed * 1000, 1),
+                endpoint=request.endpoint if has_request_context() else None,
+                statement=statement,
+                plan=plan,
+            )))
+
+    def start_template(sender, template, context, **extra):
+        metrics = current()
+        if metrics:
+            metrics._templates.append(time.perf_counter())
+
+    def end_template(sender, template, context, **extra):
+        metrics = current()
+        if metrics and metrics._templates:
+            elapsed = time.perf_counter() - metrics._templates.pop()
+            # Templates rendered from inside another one (fragments) are
+            # already part of the outer template's time.
+            if not metrics._templates:
+                metrics.template_seconds += elapsed
+
+    before_render_template.connect(start_template, app, weak=False)
+    template_rendered.connect(end_template, app, weak=False)
+
+    def add_hash_time(seconds):
+        metrics = current()
+        if metrics:
+            metrics.hash_seconds += seconds
+
+    hasher.metrics.listeners.append(add_hash_time)
+
+    @app.before_request
+    def start_request():
+        g.metrics = RequestMetrics()
+
+    @app.after_request
+    def end_request(response):
+        metrics = g.get('metrics')
+        if metrics is None:
+            return response
+        total = time.perf_counter() - metrics.start
+        endpoint = request.endpoint or 'none'
+        response.headers['Server-Timing'] = metrics.server_timing(total)
+        registry.record(endpoint, response.status_code, total, metrics)
+        request_log.info(json.dumps(dict(
+            method=request.method,
+            path=request.path,
+            endpoint=endpoint,
+            status=response.status_code,
+            ms=round(total * 1000, 1),
+            sql_count=metrics.sql_count,
+            sql_ms=round(metrics.sql_seconds * 1000, 1),
+            template_ms=round(metrics.template_seconds * 1000, 1),
+            hash_ms=round(metrics.hash_seconds * 1000, 1),
+        )))
+        return response
+
+    @app.route('/_metrics')
+    def prometheus_metrics():
+        return app.response_class(registry.prometheus(), mimetype='text/plain; version=0.0.4')
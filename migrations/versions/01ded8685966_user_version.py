@@ -0,0 +1,25 @@
+"""user row versions for ETags and fragment caches
+
+Revision ID: 01ded8685966
+Revises: a1317e2d393f
+Create Date: 2026-10-18 21:11:27.730016
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '01ded8685966'
+down_revision = 'a1317e2d393f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column('version', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('users') as batch:
+        batch.drop_column('version')
@@ -0,0 +1,36 @@
+"""denormalized user counters
+
+Revision ID: 50317e633e20
+Revises: cf2c2aff8e4b
+Create Date: 2026-10-18 21:06:40.918322
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '50317e633e20'
+down_revision = 'cf2c2aff8e4b'
+branch_labels = None
+depends_on = None
+
+COUNTERS = {
+    'messages_count': "SELECT count(*) FROM messages WHERE messages.user_id = users.id",
+    'following_count': "SELECT count(*) FROM follows WHERE follows.user_following_id = users.id",
+    'followers_count': "SELECT count(*) FROM follows WHERE follows.user_being_followed_id = users.id",
+    'likes_count': "SELECT count(*) FROM likes WHERE likes.user_id = users.id",
+}
+
+
+def upgrade():
+    for name in COUNTERS:
+        op.add_column('users', sa.Column(name, sa.Integer(), server_default='0', nullable=False))
+    # Same as User.recompute_counters() / `flask repair-counters`.
+    op.execute("UPDATE users SET " + ", ".join(f"{name} = ({count})" for name, count in COUNTERS.items()))
+
+
+def downgrade():
+    with op.batch_alter_table('users') as batch:
+        for name in reversed(list(COUNTERS)):
+            batch.drop_column(name)
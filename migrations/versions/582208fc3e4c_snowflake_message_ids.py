@@ -0,0 +1,46 @@
+"""room for snowflake message ids, server-side message timestamps
+
+Revision ID: 582208fc3e4c
+Revises: 916299482526
+Create Date: 2026-10-18 19:21:40.115032
+
+Widening message ids to bigint rewrites messages, likes and timelines
+under an exclusive lock on Postgres, so run it in a quiet period. SQLite
+integers are already 64-bit, and SQLite can't change a column default
+without copying the table, so there only the index is added.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '582208fc3e4c'
+down_revision = '916299482526'
+branch_labels = None
+depends_on = None
+
+MESSAGE_ID_COLUMNS = [('messages', 'id'), ('likes', 'message_id'), ('timelines', 'message_id')]
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        for table, column in MESSAGE_ID_COLUMNS:
+            op.alter_column(table, column, type_=sa.BigInteger(), existing_nullable=False)
+        op.alter_column('messages', 'timestamp', existing_type=sa.DateTime(), existing_nullable=False,
+                        server_default=sa.text("TIMEZONE('utc', CURRENT_TIMESTAMP)"))
+
+    with op.get_context().autocommit_block():
+        op.create_index('ix_messages_user_id_id', 'messages', ['user_id', sa.text('id DESC')],
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_messages_user_id_id', table_name='messages', postgresql_concurrently=True)
+
+    if op.get_bind().dialect.name == 'postgresql':
+        op.alter_column('messages', 'timestamp', existing_type=sa.DateTime(), existing_nullable=False,
+                        server_default=None)
+        for table, column in reversed(MESSAGE_ID_COLUMNS):
+            op.alter_column(table, column, type_=sa.Integer(), existing_nullable=False)
@@ -0,0 +1,63 @@
+"""secondary indexes
+
+Revision ID: 916299482526
+Revises: 6627d6b2e6ac
+Create Date: 2026-10-18 18:02:11.408215
+
+Every index is built with CREATE INDEX CONCURRENTLY on Postgres, which
+can't run inside a transaction, so each one gets an autocommit block.
+SQLite gets its full-text search table instead of the Postgres indexes.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '916299482526'
+down_revision = '6627d6b2e6ac'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    # Follows by follower: home timeline fan-out, backfill and feed joins.
+    ('ix_follows_user_following_id', 'follows', ['user_following_id', 'user_being_followed_id']),
+    # Like counts per message and cascades from deleted messages. Likes by
+    # user are served by the (user_id, message_id) primary key.
+    ('ix_likes_message_id', 'likes', ['message_id']),
+    # Profile pages and feeds, newest first, one index range per author.
+    ('ix_messages_user_id_timestamp_id', 'messages', ['user_id', sa.text('timestamp DESC'), sa.text('id DESC')]),
+    ('ix_timelines_owner_id_timestamp', 'timelines', ['owner_id', 'timestamp', 'message_id']),
+    ('ix_jobs_run_after', 'jobs', ['run_after']),
+]
+
+
+def upgrade():
+    postgres = op.get_bind().dialect.name == 'postgresql'
+    for name, table, columns in INDEXES:
+        with op.get_context().autocommit_block():
+            op.create_index(name, table, columns, postgresql_concurrently=True)
+
+    if postgres:
+        with op.get_context().autocommit_block():
+            op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            op.execute("CREATE INDEX CONCURRENTLY ix_users_username_trgm ON users "
+                       "USING gin (username gin_trgm_ops)")
+            op.execute("CREATE INDEX CONCURRENTLY ix_messages_text_fts ON messages "
+                       "USING gin (to_tsvector('english', text))")
+    else:
+        op.execute("CREATE VIRTUAL TABLE messages_fts USING fts5(text)")
+        op.execute("INSERT INTO messages_fts (rowid, text) SELECT id, text FROM messages")
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.execute("DROP INDEX CONCURRENTLY ix_messages_text_fts")
+            op.execute("DROP INDEX CONCURRENTLY ix_users_username_trgm")
+    else:
+        op.execute("DROP TABLE messages_fts")
+
+    for name, table, columns in reversed(INDEXES):
+        with op.get_context().autocommit_block():
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
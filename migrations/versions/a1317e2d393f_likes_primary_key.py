@@ -0,0 +1,74 @@
+"""key likes on (user_id, message_id)
+
+Revision ID: a1317e2d393f
+Revises: 50317e633e20
+Create Date: 2026-10-18 21:09:03.204417
+
+Likes had a surrogate id and a unique message_id, which allowed only one
+like per message. The table is rebuilt keyed on (user_id, message_id);
+nothing references likes, so copying it is safe on SQLite too.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a1317e2d393f'
+down_revision = '50317e633e20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("DELETE FROM likes WHERE user_id IS NULL OR message_id IS NULL")
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("DELETE FROM likes a USING likes b "
+                   "WHERE a.user_id = b.user_id AND a.message_id = b.message_id AND a.id > b.id")
+        op.drop_constraint('likes_message_id_key', 'likes', type_='unique')
+        op.drop_constraint('likes_pkey', 'likes', type_='primary')
+        op.drop_column('likes', 'id')
+        op.alter_column('likes', 'user_id', nullable=False)
+        op.alter_column('likes', 'message_id', nullable=False)
+        op.create_primary_key('likes_pkey', 'likes', ['user_id', 'message_id'])
+        return
+
+    # SQLite can't change a primary key in place, so copy the table.
+    op.rename_table('likes', 'likes_old')
+    op.create_table('likes',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('message_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['message_id'], ['messages.id'], ondelete='cascade'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('user_id', 'message_id')
+    )
+    op.execute("INSERT INTO likes (user_id, message_id) SELECT DISTINCT user_id, message_id FROM likes_old")
+    op.drop_table('likes_old')
+
+
+def downgrade():
+    # Only one like per message fits the old key; keep the earliest.
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("DELETE FROM likes a USING likes b "
+                   "WHERE a.message_id = b.message_id AND a.user_id > b.user_id")
+        op.drop_constraint('likes_pkey', 'likes', type_='primary')
+        op.execute("ALTER TABLE likes ADD COLUMN id SERIAL NOT NULL")
+        op.alter_column('likes', 'user_id', nullable=True)
+        op.alter_column('likes', 'message_id', nullable=True)
+        op.create_primary_key('likes_pkey', 'likes', ['id'])
+        op.create_unique_constraint('likes_message_id_key', 'likes', ['message_id'])
+        return
+
+    op.rename_table('likes', 'likes_new')
+    op.create_table('likes',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('message_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['message_id'], ['messages.id'], ondelete='cascade'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('message_id')
+    )
+    op.execute("INSERT INTO likes (user_id, message_id) SELECT min(user_id), message_id "
+               "FROM likes_new GROUP BY message_id")
+    op.drop_table('likes_new')
@@ -0,0 +1,50 @@
+"""materialized home timelines
+
+Revision ID: cf2c2aff8e4b
+Revises: e515c547a0d7
+Create Date: 2026-10-18 21:04:12.551870
+
+"""
+from alembic import op
+from flask import current_app
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'cf2c2aff8e4b'
+down_revision = 'e515c547a0d7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('timelines',
+    sa.Column('owner_id', sa.Integer(), nullable=False),
+    sa.Column('message_id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['message_id'], ['messages.id'], ondelete='cascade'),
+    sa.ForeignKeyConstraint(['owner_id'], ['users.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('owner_id', 'message_id')
+    )
+    # Write what posting and following would have, as Timeline.rebuild()
+    # does: every author's own messages, and each follower's copy of the
+    # latest TIMELINE_BACKFILL messages of authors within the fan-out limit.
+    op.execute(sa.text(
+        "INSERT INTO timelines (owner_id, message_id, timestamp) "
+        "SELECT user_id, id, timestamp FROM messages "
+        "UNION ALL "
+        "SELECT follows.user_following_id, latest.id, latest.timestamp "
+        "FROM follows "
+        "JOIN (SELECT id, user_id, timestamp, row_number() OVER "
+        "(PARTITION BY user_id ORDER BY timestamp DESC, id DESC) AS rank FROM messages) AS latest "
+        "ON latest.user_id = follows.user_being_followed_id "
+        "JOIN (SELECT user_being_followed_id AS user_id FROM follows "
+        "GROUP BY user_being_followed_id HAVING count(*) <= :fanout_limit) AS fanned "
+        "ON fanned.user_id = follows.user_being_followed_id "
+        "WHERE latest.rank <= :backfill_limit "
+        "AND follows.user_following_id != follows.user_being_followed_id"
+    ).bindparams(fanout_limit=current_app.config['TIMELINE_FANOUT_LIMIT'],
+                 backfill_limit=current_app.config['TIMELINE_BACKFILL']))
+
+def downgrade():
+    op.drop_table('timelines')
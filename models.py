@@ -1,12 +1,56 @@
 """SQLAlchemy models for Warbler."""
 
-from datetime import datetime
+import sqlite3
+from datetime import datetime, timedelta
+from heapq import merge
+from itertools import islice
+from threading import Lock
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, case, event, exists, func, literal, select, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql.expression import FunctionElement
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from hashing import hasher
+from pagination import paginate, position
+from replicas import RoutingSQLAlchemy, route_reads
+from search import NgramIndex, escape_like
+from snowflake import snowflakes
+
+db = RoutingSQLAlchemy()
+
+# Message ids are 64-bit so they can hold snowflake ids (see snowflake.py).
+# SQLite integers are 64-bit already, and only INTEGER keys autoincrement.
+MessageId = db.BigInteger().with_variant(db.Integer(), 'sqlite')
+
+
+class utcnow(FunctionElement):
+    """The database's current time in UTC, for server-side defaults."""
+
+    type = db.DateTime()
+
+
+@compiles(utcnow, 'postgresql')
+def postgresql_utcnow(element, compiler, **kw):
+    return "TIMEZONE('utc', CURRENT_TIMESTAMP)"
+
+
+@compiles(utcnow)
+def default_utcnow(element, compiler, **kw):
+    return "CURRENT_TIMESTAMP"
+
+
+def insert_ignoring_conflicts(table):
+    """An INSERT into `table` that skips rows colliding with a unique key."""
+
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    return table.insert()
 
 
 class Follows(db.Model):
@@ -14,6 +58,13 @@ class Follows(db.Model):
 
     __tablename__ = 'follows'
 
+    # The primary key leads with the followed user; feeds look follows up by
+    # follower, so they get an index of their own.
+
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id', 'user_following_id', 'user_being_followed_id'),
+    )
+
     user_being_followed_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -26,39 +77,101 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    @classmethod
+    def add_follow(cls, follower_id, followed_id):
+        if follower_id == followed_id:
+            raise ValueError("Users can't follow themselves")
+        follow = cls(user_following_id=follower_id, user_being_followed_id=followed_id)
+        db.session.add(follow)
+        User.adjust_counters(follower_id, following_count=1)
+        User.adjust_counters(followed_id, followers_count=1)
+
+    @classmethod
+    def delete_follow(cls, follower_id, followed_id):
+        deleted = cls.query.filter_by(user_following_id=follower_id,
+                                      user_being_followed_id=followed_id).delete(synchronize_session=False)
+        if deleted:
+            User.adjust_counters(follower_id, following_count=-1)
+            User.adjust_counters(followed_id, followers_count=-1)
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
     __tablename__ = 'likes' 
 
-    id = db.Column(
-        db.Integer,
-        primary_key=True
+    # One row per (user, message): liking is an idempotent insert on this key
+    # and unliking a single delete. Like counts are served by the message index.
+
+    __table_args__ = (
+        db.Index('ix_likes_message_id', 'message_id'),
     )
 
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
-        db.Integer,
+        MessageId,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
     )
 
     @classmethod
     def add_like(cls, user_id, message_id):
-        like = cls(user_id=user_id, message_id=message_id)
-        db.session.add(like)
-        
+        """Like a message; liking it again is a no-op. Returns whether a like was added."""
+
+        insert = insert_ignoring_conflicts(cls.__table__)
+        added = db.session.execute(insert.values(user_id=user_id, message_id=message_id)).rowcount == 1
+        if added:
+            User.adjust_counters(user_id, likes_count=1)
+            User.touch_author(message_id)
+        return added
+
     @classmethod
     def delete_like(cls, user_id, message_id):
-        like = Likes.query.filter_by(user_id=user_id).filter_by(message_id=message_id).first()
-        db.session.delete(like)
-        
-        
+        """Unlike a message; unliking it again is a no-op. Returns whether a like was removed."""
+
+        deleted = cls.query.filter_by(user_id=user_id, message_id=message_id).delete(synchronize_session=False)
+        if deleted:
+            User.adjust_counters(user_id, likes_count=-1)
+            User.touch_author(message_id)
+        return deleted == 1
+
+    @classmethod
+    def toggle_like(cls, user_id, message_id):
+        """Unlike if liked, otherwise like. Returns whether the message is now liked."""
+
+        if cls.delete_like(user_id, message_id):
+            return False
+        return cls.add_like(user_id, message_id)
+
+
+class UserProfile:
+    """Slim, cacheable snapshot of a user: the fields templates read from `g.user`.
+
+    Holds plain values only, so it can live in a cache across requests
+    without being tied to a database session.
+    """
+
+    FIELDS = ('id', 'username', 'email', 'image_url', 'header_image_url', 'bio', 'location')
+
+    def __init__(self, **fields):
+        for name in self.FIELDS:
+            setattr(self, name, fields.get(name))
+
+    def __repr__(self):
+        return f"<UserProfile #{self.id}: {self.username}>"
+
+    def is_following(self, other_user):
+        """Is this user following `other_user`?"""
+
+        found = Follows.query.filter_by(user_following_id=self.id, user_being_followed_id=other_user.id)
+        return db.session.query(found.exists()).scalar()
+
+
 class User(db.Model):
     """User in the system."""
 
@@ -104,25 +217,73 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    # Denormalized counts for the stats cards; kept in sync by the model
+    # methods that add or remove rows and repaired by `recompute_counters`.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped whenever anything shown on the user's profile changes: their
+    # fields, their counters, or the like counts of their messages. Pages and
+    # fragments built from the row use it in ETags and cache keys.
+
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Deleting a user leaves their messages, follows and likes to the
+    # database's ON DELETE CASCADE instead of loading every collection.
+
+    messages = db.relationship('Message', passive_deletes=True)
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=(Follows.user_following_id == id),
+        passive_deletes=True,
     )
 
     following = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=(Follows.user_being_followed_id == id),
+        passive_deletes=True,
     )
 
     likes = db.relationship(
         'Message',
-        secondary="likes"
+        secondary="likes",
+        passive_deletes=True,
     )
 
     def __repr__(self):
@@ -131,14 +292,54 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        found = User.query.filter(User.id == self.id, User.followers.contains(other_user))
+        return db.session.query(found.exists()).scalar()
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        found = User.query.filter(User.id == self.id, User.following.contains(other_user))
+        return db.session.query(found.exists()).scalar()
+
+    @classmethod
+    def get_profile_fields(cls, user_id):
+        """Dict of `UserProfile` fields for `user_id`, or None if there is no such user."""
+
+        columns = [getattr(cls, name) for name in UserProfile.FIELDS]
+        row = db.session.query(*columns).filter(cls.id == user_id).first()
+        return None if row is None else dict(zip(UserProfile.FIELDS, row))
+
+    @classmethod
+    def get_public_profile(cls, user_id):
+        """Dict of a user's public fields and counters, or None if there is no such user."""
+
+        columns = [cls.id, cls.username, cls.image_url, cls.header_image_url, cls.bio, cls.location,
+                   cls.messages_count, cls.following_count, cls.followers_count, cls.likes_count]
+        row = db.session.query(*columns).filter(cls.id == user_id).first()
+        return None if row is None else row._asdict()
+
+    @classmethod
+    def get_stats(cls, user_id):
+        """Counter columns for `user_id`'s stats card."""
+
+        return db.session.query(cls.messages_count, cls.following_count, cls.followers_count,
+                                cls.likes_count).filter(cls.id == user_id).first()
+
+    @classmethod
+    def get_versions(cls, *user_ids):
+        """Dict of id -> version for the given users, in one query."""
+
+        return dict(db.session.query(cls.id, cls.version).filter(cls.id.in_(user_ids)))
+
+    @classmethod
+    def get_following_ids(cls, user_id, among):
+        """Set of the ids in `among` that `user_id` follows, in one query."""
+
+        followed = db.session.query(Follows.user_being_followed_id).filter(
+            Follows.user_following_id == user_id,
+            Follows.user_being_followed_id.in_(among),
+        )
+        return {id for (id,) in followed}
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -147,7 +348,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
         if username and email and password:
-            hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+            hashed_pwd = hasher.hash(password)
 
             user = User(
                 username=username,
@@ -167,7 +368,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = cls.query.filter_by(id=id).first()
         user.password = hashed_pwd
@@ -184,18 +385,131 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        Hashes made with an outdated work factor are transparently upgraded
+        (the caller commits the new hash).
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.hash(password)
                 return user
 
         return False
 
     
+    @classmethod
+    def adjust_counters(cls, user_id, **deltas):
+        """Add `deltas` (e.g. `likes_count=1`) to a user's counters in one UPDATE."""
+
+        values = {getattr(cls, name): getattr(cls, name) + delta for name, delta in deltas.items()}
+        values[cls.version] = cls.version + 1
+        cls.query.filter_by(id=user_id).update(values, synchronize_session=False)
+
+    @classmethod
+    def touch_author(cls, message_id):
+        """Bump the version of a message's author, e.g. when its like count changes."""
+
+        author = select([Message.user_id]).where(Message.id == message_id).as_scalar()
+        cls.query.filter(cls.id == author).update({cls.version: cls.version + 1}, synchronize_session=False)
+
+    @classmethod
+    def release_counters(cls, user_id):
+        """Take a user about to be deleted out of everyone else's counters."""
+
+        followed = select([Follows.user_being_followed_id]).where(Follows.user_following_id == user_id)
+        cls.query.filter(cls.id.in_(followed)).update(
+            {cls.followers_count: cls.followers_count - 1, cls.version: cls.version + 1},
+            synchronize_session=False)
+
+        following = select([Follows.user_following_id]).where(Follows.user_being_followed_id == user_id)
+        cls.query.filter(cls.id.in_(following)).update(
+            {cls.following_count: cls.following_count - 1, cls.version: cls.version + 1},
+            synchronize_session=False)
+
+        liked = select([func.count()]).select_from(Likes.__table__.join(Message.__table__)).where(
+            Likes.user_id == cls.id).where(Message.user_id == user_id).as_scalar()
+        likers = select([Likes.user_id]).select_from(Likes.__table__.join(Message.__table__)).where(
+            Message.user_id == user_id)
+        cls.query.filter(cls.id.in_(likers)).filter(cls.id != user_id).update(
+            {cls.likes_count: cls.likes_count - liked, cls.version: cls.version + 1},
+            synchronize_session=False)
+
+        # Like counts on the messages they liked are about to drop.
+        authors = select([Message.user_id]).select_from(Likes.__table__.join(Message.__table__)).where(
+            Likes.user_id == user_id)
+        cls.query.filter(cls.id.in_(authors)).filter(cls.id != user_id).update(
+            {cls.version: cls.version + 1}, synchronize_session=False)
+
+    @classmethod
+    def recompute_counters(cls):
+        """Recompute every user's counters from the underlying tables."""
+
+        def count(model, column):
+            return select([func.count()]).select_from(model.__table__).where(column == cls.id).as_scalar()
+
+        cls.query.update({
+            cls.messages_count: count(Message, Message.user_id),
+            cls.following_count: count(Follows, Follows.user_following_id),
+            cls.followers_count: count(Follows, Follows.user_being_followed_id),
+            cls.likes_count: count(Likes, Likes.user_id),
+            cls.version: cls.version + 1,
+        }, synchronize_session=False)
+
+    @classmethod
+    def search(cls, q, page=1, per_page=30):
+        """One page of users whose username contains `q`, best matches first.
+
+        Ranked by match quality (exact, then prefix, then other substring
+        matches) and then by follower count. Returns (users, has_more).
+        """
+
+        if db.engine.dialect.name == 'postgresql':
+            q_lower = q.lower()
+            rank = case([
+                (func.lower(cls.username) == q_lower, 3),
+                (cls.username.ilike(f"{escape_like(q)}%", escape='\\'), 2),
+            ], else_=1)
+            users = cls.query.filter(
+                cls.username.ilike(f"%{escape_like(q)}%", escape='\\')
+            ).order_by(
+                rank.desc(),
+                func.similarity(cls.username, q).desc(),
+                cls.followers_count.desc(),
+                cls.id,
+            ).offset((page - 1) * per_page).limit(per_page + 1).all()
+            return users[:per_page], len(users) > per_page
+
+        scores = username_index().search(q)
+        ranked = []
+        ids = list(scores)
+        for start in range(0, len(ids), 500):
+            rows = db.session.query(cls.id, cls.username, cls.followers_count).filter(
+                cls.id.in_(ids[start:start + 500]))
+            ranked.extend(
+                (scores[id], followers_count, -id)
+                for id, username, followers_count in rows
+                if q.lower() in username.lower()
+            )
+        ranked.sort(reverse=True)
+        page_ids = [-neg_id for _, _, neg_id in ranked[(page - 1) * per_page:page * per_page]]
+        users = {user.id: user for user in cls.query.filter(cls.id.in_(page_ids))}
+        return [users[id] for id in page_ids if id in users], len(ranked) > page * per_page
+
+    @classmethod
+    def list_page(cls, after=None, per_page=30):
+        """One page of all users in id order. Returns (users, has_more)."""
+
+        query = cls.query
+        if after:
+            query = query.filter(cls.id > after)
+        users = query.order_by(cls.id).limit(per_page + 1).all()
+        return users[:per_page], len(users) > per_page
+
     @classmethod
     def update_user(cls, id, email, image_url, header_image_url, bio, location):
         user = User.query.filter_by(id=id).first()
@@ -209,15 +523,56 @@ class User(db.Model):
             user.bio = bio
         if location:
             user.location = location
+        user.version = User.version + 1
         db.session.commit()
 
+# Username search on Postgres: trigram GIN index serving ILIKE '%q%'.
+event.listen(
+    User.__table__,
+    'after_create',
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm;"
+        "CREATE INDEX IF NOT EXISTS ix_users_username_trgm ON users USING gin (username gin_trgm_ops)"
+        ).execute_if(dialect='postgresql'),
+)
+
+# Username search elsewhere: an in-process n-gram index, built on first use
+# and kept current by the mapper events below. Search results are re-checked
+# against the database, so rows removed behind its back are simply skipped.
+_username_index = None
+_username_index_lock = Lock()
+
+
+def username_index():
+    global _username_index
+    with _username_index_lock:
+        if _username_index is None:
+            index = NgramIndex()
+            for id, username in db.session.query(User.id, User.username):
+                index.add(id, username)
+            _username_index = index
+    return _username_index
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+def index_username(mapper, connection, user):
+    if _username_index is not None:
+        _username_index.add(user.id, user.username)
+
+
+@event.listens_for(User, 'after_delete')
+def unindex_username(mapper, connection, user):
+    if _username_index is not None:
+        _username_index.remove(user.id)
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
 
     id = db.Column(
-        db.Integer,
+        MessageId,
         primary_key=True,
     )
 
@@ -229,7 +584,8 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
+        server_default=utcnow(),
     )
 
     user_id = db.Column(
@@ -242,24 +598,434 @@ class Message(db.Model):
     
     @classmethod
     def get_message_by_id(cls, id):
-        message = Message.query.get(id)
+        message = Message.query.options(joinedload(Message.user)).get(id)
         return message
         
     @classmethod
-    def get_filtered_messages(cls, filtered_list):
-        messages = Message.query.filter(Message.user_id.in_(filtered_list)).order_by(Message.timestamp.desc()).limit(100).all()
+    def timeline_rows(cls, viewer_id=None):
+        """Query for timeline rows: message columns with the author's joined in.
+
+        Rows are plain named tuples (id, text, timestamp, user_id, username,
+        image_url, like_count, liked) rather than ORM entities, so rendering a
+        page of messages never lazy-loads `message.user`. `like_count` and
+        `liked` (whether `viewer_id` likes the message) are correlated
+        subqueries in the same statement, served by the likes indexes.
+        """
+
+        like_count = select([func.count()]).where(Likes.message_id == Message.id).correlate(Message).as_scalar()
+        if viewer_id:
+            liked = exists().where(Likes.message_id == Message.id).where(
+                Likes.user_id == viewer_id).correlate(Message)
+        else:
+            liked = literal(False)
+
+        return db.session.query(
+            Message.id,
+            Message.text,
+            Message.timestamp,
+            Message.user_id,
+            User.username,
+            User.image_url,
+            like_count.label('like_count'),
+            liked.label('liked'),
+        ).join(User, Message.user_id == User.id)
+
+    @classmethod
+    def get_row(cls, message_id, viewer_id=None):
+        """A single timeline row for `message_id`, or None."""
+
+        return Message.timeline_rows(viewer_id).filter(Message.id == message_id).first()
+
+    @classmethod
+    def get_filtered_messages(cls, filtered_list, before=None, limit=100, viewer_id=None):
+        query = Message.timeline_rows(viewer_id).filter(Message.user_id.in_(filtered_list))
+        messages = paginate(query, Message.timestamp, Message.id, before, limit).all()
         return messages
     
     @classmethod
-    def get_liked_messages(cls, liked):
-        messages = Message.query.filter(Message.id.in_(liked)).order_by(Message.timestamp.desc()).limit(100).all()
+    def get_followed_messages(cls, viewer_id, before=None, limit=100, min_followers=None):
+        """Messages by `viewer_id` and everyone they follow, newest first.
+
+        Authors come from joining the viewer's follows rows in SQL rather than
+        from an id list built in Python, so the statement is the same size
+        for any number of follows and each author is read from its
+        (user_id, timestamp, id) index. With `min_followers`, only followed
+        authors with more followers than that are included, and the viewer's
+        own messages are left out.
+        """
+
+        authors = select([Follows.user_being_followed_id.label('author_id')]).where(
+            Follows.user_following_id == viewer_id)
+        if min_followers is None:
+            authors = authors.union_all(select([literal(viewer_id, db.Integer).label('author_id')]))
+        else:
+            authors = authors.select_from(
+                Follows.__table__.join(User.__table__, User.id == Follows.user_being_followed_id)
+            ).where(User.followers_count > min_followers)
+        authors = authors.alias('authors')
+
+        query = Message.timeline_rows(viewer_id).join(authors, authors.c.author_id == Message.user_id)
+        return paginate(query, Message.timestamp, Message.id, before, limit).all()
+
+    @classmethod
+    def get_liked_by(cls, user_id, before=None, limit=100, viewer_id=None):
+        """Messages `user_id` liked, other than their own."""
+
+        query = Message.timeline_rows(viewer_id).join(Likes, Likes.message_id == Message.id).filter(
+            Likes.user_id == user_id, Message.user_id != user_id)
+        messages = paginate(query, Message.timestamp, Message.id, before, limit).all()
         return messages
 
     @classmethod
     def delete_message(cls, message_id):
         message = Message.query.get(message_id)
+        likers = select([Likes.user_id]).where(Likes.message_id == message_id)
+        User.query.filter(User.id.in_(likers)).update(
+            {User.likes_count: User.likes_count - 1, User.version: User.version + 1},
+            synchronize_session=False)
+        User.adjust_counters(message.user_id, messages_count=-1)
         db.session.delete(message)
 
+    @classmethod
+    def add_to_search_index(cls, message):
+        """Index a freshly flushed message for `Message.search`.
+
+        Postgres maintains its GIN index itself; SQLite needs the row copied
+        into the FTS5 table.
+        """
+
+        if db.engine.dialect.name == 'sqlite':
+            db.session.execute(text("INSERT OR REPLACE INTO messages_fts (rowid, text) VALUES (:id, :text)"),
+                               {'id': message.id, 'text': message.text})
+
+    @classmethod
+    def remove_from_search_index(cls, message_id):
+        if db.engine.dialect.name == 'sqlite':
+            db.session.execute(text("DELETE FROM messages_fts WHERE rowid = :id"), {'id': message_id})
+
+    @classmethod
+    def prune_search_index(cls):
+        """Drop search entries whose messages are gone, e.g. after a user is deleted."""
+
+        if db.engine.dialect.name == 'sqlite':
+            db.session.execute(text("DELETE FROM messages_fts WHERE rowid NOT IN (SELECT id FROM messages)"))
+
+    @classmethod
+    def rebuild_search_index(cls):
+        """Re-index every message (used after bulk loads)."""
+
+        if db.engine.dialect.name == 'sqlite':
+            db.session.execute(text("DELETE FROM messages_fts"))
+            db.session.execute(text("INSERT INTO messages_fts (rowid, text) SELECT id, text FROM messages"))
+
+    @classmethod
+    def search(cls, q, user_id=None, before=None, limit=100, viewer_id=None):
+        """One page of messages matching the words in `q`, newest first.
+
+        Optionally restricted to one author. Rows are the same shape as
+        `timeline_rows` and page with the same (timestamp, id) cursors.
+        """
+
+        dialect = db.engine.dialect.name
+        if dialect == 'postgresql':
+            matches = func.to_tsvector('english', Message.text).op('@@')(func.plainto_tsquery('english', q))
+        elif dialect == 'sqlite':
+            # Quote every word so FTS5 operators in user input are matched literally.
+            phrase = ' '.join('"' + word.replace('"', '""') + '"' for word in q.split())
+            fts = text("SELECT rowid FROM messages_fts WHERE messages_fts MATCH :q")
+            matches = Message.id.in_(fts.bindparams(q=phrase).columns(rowid=db.Integer))
+        else:
+            matches = Message.text.ilike(f"%{escape_like(q)}%", escape='\\')
+
+        query = Message.timeline_rows(viewer_id).filter(matches)
+        if user_id:
+            query = query.filter(Message.user_id == user_id)
+        messages = paginate(query, Message.timestamp, Message.id, before, limit).all()
+        return messages
+
+# Serves per-author pages and every keyset page of a feed without a sort step.
+db.Index(
+    'ix_messages_user_id_timestamp_id',
+    Message.user_id,
+    Message.timestamp.desc(),
+    Message.id.desc(),
+)
+
+# The same, for feeds paged by snowflake id alone.
+db.Index(
+    'ix_messages_user_id_id',
+    Message.user_id,
+    Message.id.desc(),
+)
+
+
+@event.listens_for(Message, 'before_insert')
+def assign_snowflake(mapper, connection, message):
+    if snowflakes.enabled and message.id is None:
+        message.id = snowflakes.next_id()
+
+
+# Full-text search: a GIN index over the message tsvector on Postgres, an FTS5
+# table keyed by message id on SQLite.
+event.listen(
+    Message.__table__,
+    'after_create',
+    DDL("CREATE INDEX IF NOT EXISTS ix_messages_text_fts ON messages "
+        "USING gin (to_tsvector('english', text))").execute_if(dialect='postgresql'),
+)
+event.listen(
+    Message.__table__,
+    'after_create',
+    DDL("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(text)").execute_if(dialect='sqlite'),
+)
+event.listen(
+    Message.__table__,
+    'before_drop',
+    DDL("DROP TABLE IF EXISTS messages_fts").execute_if(dialect='sqlite'),
+)
+
+
+class Timeline(db.Model):
+    """Materialized home timeline: one row per message delivered to an owner.
+
+    Rows are written when a message is posted (fan-out-on-write) and when a
+    follow is added or removed. Authors with more followers than the fan-out
+    limit are skipped at write time and merged in at read time instead.
+    """
+
+    __tablename__ = 'timelines'
+
+    __table_args__ = (
+        db.Index('ix_timelines_owner_id_timestamp', 'owner_id', 'timestamp', 'message_id'),
+    )
+
+    owner_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        MessageId,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    @classmethod
+    def is_celebrity(cls, user_id, fanout_limit):
+        """Does `user_id` have too many followers to fan out on write?"""
+
+        followers = db.session.query(User.followers_count).filter_by(id=user_id).scalar()
+        return followers > fanout_limit
+
+    @classmethod
+    def fan_out(cls, message, fanout_limit):
+        """Deliver a freshly flushed message to its author and followers."""
+
+        db.session.add(cls(owner_id=message.user_id, message_id=message.id, timestamp=message.timestamp))
+        if cls.is_celebrity(message.user_id, fanout_limit):
+            return
+
+        followers = select([
+            Follows.user_following_id,
+            literal(message.id, MessageId),
+            literal(message.timestamp, db.DateTime),
+        ]).where(
+            (Follows.user_being_followed_id == message.user_id)
+            # The author's own row is already added above.
+            & (Follows.user_following_id != message.user_id)
+        )
+        # A follow made since the post may have backfilled the message already.
+        insert = insert_ignoring_conflicts(cls.__table__)
+        db.session.execute(insert.from_select(['owner_id', 'message_id', 'timestamp'], followers))
+
+    @classmethod
+    def backfill(cls, owner_id, author_id, limit):
+        """Copy the latest `limit` messages of a newly followed author into a timeline."""
+
+        latest = select([
+            literal(owner_id, db.Integer),
+            Message.id,
+            Message.timestamp,
+        ]).where(Message.user_id == author_id).order_by(Message.timestamp.desc()).limit(limit)
+        # Messages still waiting to be delivered may have been fanned out already.
+        insert = insert_ignoring_conflicts(cls.__table__)
+        db.session.execute(insert.from_select(['owner_id', 'message_id', 'timestamp'], latest))
+
+    @classmethod
+    def prune(cls, owner_id, author_id):
+        """Remove an unfollowed author's messages from a timeline."""
+
+        authored = select([Message.id]).where(Message.user_id == author_id)
+        db.session.execute(cls.__table__.delete().where(cls.owner_id == owner_id).where(cls.message_id.in_(authored)))
+
+    @classmethod
+    def rebuild(cls, fanout_limit, backfill_limit):
+        """Recompute every timeline from messages and follows (used after seeding).
+
+        Writes what posting and following would have: every author's own
+        messages, plus each follower's copy of the latest `backfill_limit`
+        messages of authors within the fan-out limit.
+        """
+
+        db.session.execute(cls.__table__.delete())
+        own = select([Message.user_id, Message.id, Message.timestamp])
+        newest = func.row_number().over(partition_by=Message.user_id,
+                                        order_by=(Message.timestamp.desc(), Message.id.desc()))
+        latest = select([Message.user_id, Message.id, Message.timestamp, newest.label('rank')]).alias('latest')
+        followed = select([Follows.user_following_id, latest.c.id, latest.c.timestamp]).select_from(
+            Follows.__table__
+            .join(latest, latest.c.user_id == Follows.user_being_followed_id)
+            .join(User.__table__, User.id == Follows.user_being_followed_id)
+        ).where(
+            (latest.c.rank <= backfill_limit)
+            & (User.followers_count <= fanout_limit)
+            & (Follows.user_following_id != Follows.user_being_followed_id)
+        )
+        db.session.execute(cls.__table__.insert().from_select(['owner_id', 'message_id', 'timestamp'], own.union_all(followed)))
+
+    @classmethod
+    def get_home_messages(cls, owner_id, fanout_limit, before=None, limit=100):
+        """One page of messages for `owner_id`'s homepage.
+
+        Reads one index-ordered slice of the materialized timeline and merges
+        in posts from followed authors that are too big to fan out on write.
+        Both slices are already newest first, so they are merged in Python
+        rather than sorted together by the database.
+        """
+
+        delivered = Message.timeline_rows(owner_id).join(cls, cls.message_id == Message.id).filter(cls.owner_id == owner_id)
+        messages = paginate(delivered, cls.timestamp, cls.message_id, before, limit).all()
+        pulled = Message.get_followed_messages(owner_id, before, limit, min_followers=fanout_limit)
+        if pulled:
+            newest_first = merge(messages, pulled, key=position, reverse=True)
+            messages = list(islice(unique_messages(newest_first), limit))
+        return messages
+
+
+class Job(db.Model):
+    """A background job in the durable queue (see jobs.py).
+
+    Workers claim a row by leasing it until `locked_until`; finished jobs are
+    deleted, failed ones are retried after `run_after`, and jobs out of
+    retries are kept with `run_after` and `key` cleared for inspection.
+    """
+
+    __tablename__ = 'jobs'
+
+    __table_args__ = (
+        db.Index('ix_jobs_run_after', 'run_after'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # Enqueueing a key that is already pending is a no-op.
+    key = db.Column(
+        db.Text,
+        unique=True,
+    )
+
+    payload = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    run_after = db.Column(
+        db.DateTime,
+        default=datetime.utcnow,
+    )
+
+    locked_until = db.Column(
+        db.DateTime,
+    )
+
+    @classmethod
+    def push(cls, name, key, payload):
+        """Queue a job; returns False if a job with the same key is already queued."""
+
+        insert = insert_ignoring_conflicts(cls.__table__)
+        row = dict(name=name, key=key, payload=payload, attempts=0, run_after=datetime.utcnow())
+        return db.session.execute(insert.values(**row)).rowcount == 1
+
+    @classmethod
+    def claim(cls, lease):
+        """Lease the oldest runnable job for `lease` seconds; returns it, or None.
+
+        The lease is taken with a conditional UPDATE, so when several workers
+        race for the same row only one of them gets it.
+        """
+
+        now = datetime.utcnow()
+        runnable = (cls.run_after <= now) & (cls.locked_until.is_(None) | (cls.locked_until < now))
+        job = cls.query.filter(runnable).order_by(cls.id).first()
+        if job is None:
+            return None
+        claimed = cls.query.filter(cls.id == job.id, runnable).update({
+            cls.locked_until: now + timedelta(seconds=lease),
+            cls.attempts: cls.attempts + 1,
+        }, synchronize_session=False)
+        db.session.commit()
+        return cls.query.get(job.id) if claimed else None
+
+    @classmethod
+    def retry(cls, job_id, delay):
+        cls.query.filter_by(id=job_id).update({
+            cls.run_after: datetime.utcnow() + timedelta(seconds=delay),
+            cls.locked_until: None,
+        }, synchronize_session=False)
+
+    @classmethod
+    def bury(cls, job_id):
+        # Give up the key, so the same work can be queued again.
+        cls.query.filter_by(id=job_id).update({cls.run_after: None, cls.locked_until: None, cls.key: None},
+                                              synchronize_session=False)
+
+    @classmethod
+    def depth(cls):
+        """Number of jobs waiting to run or running."""
+
+        return cls.query.filter(cls.run_after.isnot(None)).count()
+
+
+def unique_messages(messages):
+    """Drop repeated messages from an iterable, keeping the first of each."""
+
+    seen = set()
+    for message in messages:
+        if message.id not in seen:
+            seen.add(message.id)
+            yield message
+
+
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """SQLite ignores foreign keys, and so ON DELETE CASCADE, unless asked per connection."""
+
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys = ON")
+        cursor.close()
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -268,3 +1034,4 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    route_reads(app)
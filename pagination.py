@@ -0,0 +1,71 @@
+"""Keyset (cursor) pagination helpers for Warbler feeds.
+
+Feeds are ordered newest first by (timestamp, id). A page is fetched with
+`WHERE (timestamp, id) < (:ts, :id)`, so every page costs the same as the
+first one no matter how far back a user scrolls. The position is handed to
+the browser as an opaque `?before=` cursor.
+
+With snowflake message ids (see snowflake.py) the id already orders rows by
+time, so pages are keyed on the id alone.
+"""
+
+import base64
+import binascii
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+from snowflake import snowflakes
+
+
+def encode_cursor(timestamp, id):
+    """Encode a (timestamp, id) position as an opaque URL-safe string."""
+
+    raw = f"{timestamp.isoformat()}|{id}".encode('UTF-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor made by `encode_cursor`.
+
+    Returns a (timestamp, id) tuple, or None if the cursor is missing or
+    malformed (callers then serve the first page).
+    """
+
+    if not cursor:
+        return None
+
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('UTF-8')
+        timestamp, id = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+
+
+def paginate(query, timestamp_col, id_col, before, limit):
+    """Order `query` newest first and restrict it to one page before `before`."""
+
+    if snowflakes.enabled:
+        if before:
+            query = query.filter(id_col < before[1])
+        return query.order_by(id_col.desc()).limit(limit)
+
+    if before:
+        query = query.filter(tuple_(timestamp_col, id_col) < tuple_(*before))
+    return query.order_by(timestamp_col.desc(), id_col.desc()).limit(limit)
+
+
+def position(row):
+    """The key `paginate` orders rows by, for merging pages in Python."""
+
+    return row.id if snowflakes.enabled else (row.timestamp, row.id)
+
+
+def next_cursor(messages, limit):
+    """Cursor for the page after `messages`, or None if this is the last page."""
+
+    if len(messages) < limit:
+        return None
+    last = messages[-1]
+    return encode_cursor(last.timestamp, last.id)
@@ -0,0 +1,54 @@
+"""Read/write splitting between a primary database and a read replica.
+
+When a `replica` bind is configured (see `DATABASE_REPLICA_URL` in app.py),
+queries made while handling GET and HEAD requests go to the replica, and
+everything else, including any flush, goes to the primary. After a request
+that may have written, the browser session is pinned to the primary for
+`REPLICA_STICKY_SECONDS`, so users read their own writes despite replica lag.
+"""
+
+import time
+
+from flask import g, has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import orm
+
+REPLICA_BIND = 'replica'
+READ_METHODS = ('GET', 'HEAD')
+STICKY_KEY = 'primary_until'
+
+
+def replica_configured(app):
+    return REPLICA_BIND in (app.config['SQLALCHEMY_BINDS'] or {})
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends reads to the replica during read-only requests."""
+
+    def get_bind(self, mapper=None, clause=None):
+        if (not self._flushing and has_request_context() and g.get('use_replica')
+                and replica_configured(self.app)):
+            return get_state(self.app).db.get_engine(self.app, bind=REPLICA_BIND)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy extension using `RoutingSession`."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def route_reads(app):
+    """Register the request hooks choosing the database for each request."""
+
+    @app.before_request
+    def choose_database():
+        g.use_replica = (request.method in READ_METHODS and replica_configured(app)
+                         and session.get(STICKY_KEY, 0) < time.time())
+
+    @app.after_request
+    def stick_to_primary(response):
+        if request.method not in READ_METHODS and replica_configured(app):
+            session[STICKY_KEY] = time.time() + app.config['REPLICA_STICKY_SECONDS']
+        return response
@@ -0,0 +1,89 @@
+"""Search helpers that don't depend on a particular database.
+
+Postgres serves username search from a `pg_trgm` GIN index (see
+`User.search`). Other databases, SQLite in local runs and tests, use the
+in-process `NgramIndex` below instead of a leading-wildcard table scan.
+"""
+
+import threading
+from collections import defaultdict
+
+
+def escape_like(text, escape='\\'):
+    """Escape LIKE wildcards in user input."""
+
+    return text.replace(escape, escape * 2).replace('%', escape + '%').replace('_', escape + '_')
+
+
+def match_score(query, text):
+    """How well `text` matches `query` (both lowercase); higher is better.
+
+    Exact matches beat prefix matches, which beat other substring matches.
+    Within a tier, shorter texts (a larger share of the text matched) win.
+    """
+
+    if text == query:
+        tier = 3
+    elif text.startswith(query):
+        tier = 2
+    else:
+        tier = 1
+    return tier + len(query) / len(text)
+
+
+class NgramIndex:
+    """In-process substring index over short strings such as usernames.
+
+    Every 1- to `n`-gram of each text is posted to the ids containing it, so a
+    substring query only has to check the ids shared by all of its grams.
+    """
+
+    def __init__(self, n=3):
+        self.n = n
+        self._postings = defaultdict(set)
+        self._texts = {}
+        self._lock = threading.Lock()
+
+    def _grams(self, text, size):
+        return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+    def add(self, id, text):
+        text = text.lower()
+        with self._lock:
+            self._remove(id)
+            self._texts[id] = text
+            for size in range(1, self.n + 1):
+                for gram in self._grams(text, size):
+                    self._postings[gram].add(id)
+
+    def remove(self, id):
+        with self._lock:
+            self._remove(id)
+
+    def _remove(self, id):
+        text = self._texts.pop(id, None)
+        if text is None:
+            return
+        for size in range(1, self.n + 1):
+            for gram in self._grams(text, size):
+                self._postings[gram].discard(id)
+
+    def search(self, query):
+        """Dict of id -> match score for every text containing `query`."""
+
+        query = query.lower()
+        if not query:
+            return {}
+
+        with self._lock:
+            grams = self._grams(query, min(len(query), self.n))
+            postings = sorted((self._postings.get(gram, set()) for gram in grams), key=len)
+            candidates = set.intersection(*postings)
+            return {
+                id: match_score(query, self._texts[id])
+                for id in candidates
+                if query in self._texts[id]
+            }
+
+    def __len__(self):
+        return len(self._texts)
@@ -0,0 +1,75 @@
+"""Time-sortable message ids ("snowflakes") generated by the app.
+
+An id packs, high bits first, the milliseconds since `EPOCH`, the id of the
+worker process that made it and a per-millisecond sequence number. Ids from
+one worker always increase, and ids from different workers sort by time
+to within a millisecond, so feeds can be ordered and paged by the id alone.
+
+Ids fit in 53 bits, so they survive a round trip through JavaScript
+numbers in the JSON API. Each process serving requests at the same time
+needs its own worker id; there is room for 64.
+"""
+
+import threading
+import time
+from datetime import datetime, timedelta
+
+EPOCH = datetime(2020, 1, 1)
+
+WORKER_BITS = 6
+SEQUENCE_BITS = 6
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+_EPOCH_MS = int((EPOCH - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+class SnowflakeIds:
+    """Hands out snowflake ids for one worker process."""
+
+    def __init__(self):
+        self.enabled = False
+        self.worker_id = 0
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+
+    def configure(self, enabled=False, worker_id=None):
+        """Turn snowflake ids on or off; call once at startup.
+
+        `worker_id` is required when enabling them, and must be unique among
+        the processes making ids at the same time.
+        """
+
+        if enabled:
+            if worker_id is None:
+                raise ValueError("Snowflake ids need an explicitly configured worker id")
+            if not 0 <= worker_id <= MAX_WORKER_ID:
+                raise ValueError(f"worker_id must be between 0 and {MAX_WORKER_ID}")
+        self.enabled = enabled
+        self.worker_id = worker_id or 0
+
+    def next_id(self):
+        with self._lock:
+            # Never go backwards, even if the clock does.
+            now = max(int(time.time() * 1000) - _EPOCH_MS, self._last_ms)
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # This millisecond is used up; wait for the next one.
+                    while now <= self._last_ms:
+                        time.sleep(0.0001)
+                        now = int(time.time() * 1000) - _EPOCH_MS
+            else:
+                self._sequence = 0
+            self._last_ms = now
+            return (now << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self._sequence
+
+
+def id_timestamp(id):
+    """When the snowflake `id` was made, as a naive UTC datetime."""
+
+    return EPOCH + timedelta(milliseconds=id >> (WORKER_BITS + SEQUENCE_BITS))
+
+
+snowflakes = SnowflakeIds()
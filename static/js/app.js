@@ -1,24 +1,70 @@
 
 /**
  * Handles likes for likes.html
+ *
+ * Clicks update the page straight away and are coalesced client-side: the
+ * final like state of every message touched within LIKE_FLUSH_DELAY ms is
+ * sent in one request to /likes/batch, and messages clicked back to where
+ * they started are not sent at all.
  */
+const LIKE_FLUSH_DELAY = 400
+
+let pendingLikes = {}
+let likeFlushTimer = null
+
 function doLike(args) {
     let [id, message_id] = args.split(',')
-    let count = parseInt($(".likes").text())
-    if($(id).hasClass("not-liked")) {
+    message_id = message_id.trim()
+    // Only the viewer's own stats card tracks their like total.
+    let total = $(".likes[data-viewer]")
+    let count = parseInt(total.text())
+    let liked = $(id).hasClass("not-liked")
+    let likeCount = $(id).siblings(".like-count")
+    let messageLikes = parseInt(likeCount.text())
+    if(liked) {
         ++count
-        $(".likes").text(count.toString())
+        ++messageLikes
+        total.text(count.toString())
         $(id).removeClass("not-liked").addClass("liked")
     } else {
         --count   
-        $(".likes").text(count.toString())
+        --messageLikes
+        total.text(count.toString())
         $(id).removeClass("liked").addClass("not-liked")
     }
+    likeCount.text(messageLikes.toString())
+
+    if(!(message_id in pendingLikes)) {
+        pendingLikes[message_id] = {initial: !liked}
+    }
+    pendingLikes[message_id].liked = liked
+
+    clearTimeout(likeFlushTimer)
+    likeFlushTimer = setTimeout(flushLikes, LIKE_FLUSH_DELAY)
+}
+
+function flushLikes(unloading) {
+    let likes = {}
+    for(let [message_id, state] of Object.entries(pendingLikes)) {
+        if(state.liked !== state.initial) {
+            likes[message_id] = state.liked
+        }
+    }
+    pendingLikes = {}
+    if(Object.keys(likes).length === 0) {
+        return
+    }
+    let body = JSON.stringify({likes : likes})
+    if(unloading === true && navigator.sendBeacon) {
+        navigator.sendBeacon('/likes/batch', new Blob([body], {type : 'application/json'}))
+        return
+    }
     $.ajax({
-        data : {
-            message_id : message_id
-        },
+        data : body,
+        contentType : 'application/json',
         type : 'post',
-        url : '/do_like'
+        url : '/likes/batch'
     });
 }
+
+window.addEventListener('pagehide', () => flushLikes(true))
@@ -0,0 +1,41 @@
+"""Cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+from unittest import TestCase, mock
+
+from cache import MemoryCache, make_cache
+
+
+class MemoryCacheTestCase(TestCase):
+    """Test the in-process LRU cache."""
+
+    def test_get_set_delete(self):
+        cache = MemoryCache()
+        self.assertIsNone(cache.get("a"))
+        cache.set("a", {"id": 1})
+        self.assertEqual({"id": 1}, cache.get("a"))
+        cache.delete("a")
+        self.assertIsNone(cache.get("a"))
+
+    def test_lru_eviction(self):
+        cache = MemoryCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(1, cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+
+    def test_ttl(self):
+        cache = MemoryCache(ttl=10)
+        with mock.patch("cache.time.monotonic", return_value=100):
+            cache.set("a", 1)
+        with mock.patch("cache.time.monotonic", return_value=111):
+            self.assertIsNone(cache.get("a"))
+
+    def test_make_cache(self):
+        self.assertIsInstance(make_cache(None), MemoryCache)
@@ -0,0 +1,117 @@
+"""Job queue tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+import os
+import threading
+from unittest import TestCase
+
+from models import db, Job
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+
+# Now we can import app
+
+from app import app
+from jobs import jobs
+
+db.create_all()
+
+
+class JobQueueTestCase(TestCase):
+    """Test running jobs inline, on workers and from the jobs table."""
+
+    def setUp(self):
+        Job.query.delete()
+        db.session.commit()
+
+        self.calls = []
+        self.failures = 0
+
+        @jobs.task('record')
+        def record(value):
+            if self.failures:
+                self.failures -= 1
+                raise RuntimeError("flaky")
+            self.calls.append(value)
+
+    def tearDown(self):
+        db.session.rollback()
+        jobs.configure(app)
+
+    def test_inline_jobs(self):
+        jobs.configure(app, retries=2, backoff=10)
+        jobs.enqueue('record', value=1)
+        self.assertEqual([1], self.calls)
+
+        """Test a failing inline job is recorded once, without retries or backoff"""
+        failed, retried = jobs.metrics.failed, jobs.metrics.retried
+        self.failures = 1
+        jobs.enqueue('record', value=2)
+        self.assertEqual([1], self.calls)
+        self.assertEqual((failed + 1, retried), (jobs.metrics.failed, jobs.metrics.retried))
+
+    def test_worker_retries(self):
+        jobs.configure(app, workers=1, retries=2, backoff=0)
+        self.failures = 2
+        jobs.enqueue('record', value=1)
+        jobs.shutdown()
+        self.assertEqual([1], self.calls)
+
+    def test_idempotency_keys(self):
+        release = threading.Event()
+        jobs.task('wait')(lambda: release.wait(5))
+
+        jobs.configure(app, workers=1)
+        jobs.enqueue('wait')
+        self.assertTrue(jobs.enqueue('record', key="a", value=1))
+        self.assertFalse(jobs.enqueue('record', key="a", value=1))
+        release.set()
+        jobs.shutdown()
+        self.assertEqual([1], self.calls)
+
+        """Test a key can be used again once its job has run"""
+        jobs.configure(app)
+        self.assertTrue(jobs.enqueue('record', key="a", value=2))
+        self.assertEqual([1, 2], self.calls)
+
+    def test_workers(self):
+        jobs.configure(app, workers=2)
+        for value in range(10):
+            jobs.enqueue('record', value=value)
+        jobs.shutdown()
+        self.assertEqual(list(range(10)), sorted(self.calls))
+        self.assertEqual(0, jobs.depth())
+
+    def test_durable_queue(self):
+        jobs.configure(app, durable=True, retries=1, backoff=0)
+        jobs.enqueue('record', key="a", value=1)
+        self.assertFalse(jobs.enqueue('record', key="a", value=1))
+        self.assertEqual(1, jobs.depth())
+        self.assertEqual([], self.calls)
+
+        self.assertEqual(1, jobs.work())
+        self.assertEqual([1], self.calls)
+        self.assertEqual(0, jobs.depth())
+
+        """Test a job out of retries is kept but not run again"""
+        self.failures = 2
+        jobs.enqueue('record', key="b", value=2)
+        self.assertEqual(2, jobs.work())
+        self.assertEqual(0, jobs.depth())
+        self.assertEqual(1, Job.query.count())
+        self.assertEqual(0, jobs.work())
+
+        """Test a buried job's key can be queued again"""
+        self.assertTrue(jobs.enqueue('record', key="b", value=3))
+        self.assertEqual(1, jobs.work())
+        self.assertEqual([1, 3], self.calls)
@@ -6,9 +6,13 @@
 
 
 import os
+import time
+from datetime import datetime, timedelta
 from unittest import TestCase
 
 from models import db, User, Message, Follows, Likes
+from pagination import decode_cursor, next_cursor
+from snowflake import snowflakes, id_timestamp
 from flask_bcrypt import Bcrypt
 
 bcrypt = Bcrypt()
@@ -61,18 +65,111 @@ class MessageModelTestCase(TestCase):
         testmessage = Message.get_filtered_messages(filtered_List)
         self.assertEqual(user1.id, testmessage[0].user_id)
         
-        """Test get_liked_messages"""
-        hashed_pwd2 = bcrypt.generate_password_hash("HASHED_PASSWORD2").decode('UTF-8')
-        user2 = User(email="test2@test.com", username="testuser2", password=hashed_pwd2)
-        db.session.add(user1)
-        db.session.commit()
-        user2.likes.append(message1.id)
-        liked = [message1.id]
-        testmessage = Message.get_liked_messages(liked)
-        self.assertEqual(message1.id, testmessage[0].id)
-        
         """Test delete_message"""
         before = db.session.query(Message).count()
         Message.delete_message(message1.id)
         after = db.session.query(Message).count()
-        self.assertEqual(before - 1, after)
\ No newline at end of file
+        self.assertEqual(before - 1, after)
+
+    def test_keyset_pagination(self):
+        """Pages follow each other without gaps or repeats"""
+        hashed_pwd1 = bcrypt.generate_password_hash("HASHED_PASSWORD1").decode('UTF-8')
+        user1 = User(email="test1@test.com", username="testuser1", password=hashed_pwd1)
+        db.session.add(user1)
+        db.session.commit()
+        for i in range(5):
+            db.session.add(Message(text=f"TestMessage{i}", user_id=user1.id))
+        db.session.commit()
+
+        first = Message.get_filtered_messages([user1.id], limit=3)
+        cursor = next_cursor(first, 3)
+        second = Message.get_filtered_messages([user1.id], before=decode_cursor(cursor), limit=3)
+        self.assertEqual(3, len(first))
+        self.assertEqual(2, len(second))
+        self.assertIsNone(next_cursor(second, 3))
+        ids = [m.id for m in first + second]
+        self.assertEqual(sorted(ids, reverse=True), ids)
+        self.assertIsNone(decode_cursor("not-a-cursor"))
+
+    def test_timestamp_defaults(self):
+        """Each message is stamped when it is inserted, by the app or the database"""
+        hashed_pwd = bcrypt.generate_password_hash("HASHED_PASSWORD").decode('UTF-8')
+        user1 = User(email="test1@test.com", username="testuser1", password=hashed_pwd)
+        db.session.add(user1)
+        db.session.commit()
+        message1 = Message(text="TestMessage1", user_id=user1.id)
+        db.session.add(message1)
+        db.session.commit()
+        time.sleep(0.01)
+        message2 = Message(text="TestMessage2", user_id=user1.id)
+        db.session.add(message2)
+        db.session.commit()
+        self.assertLess(message1.timestamp, message2.timestamp)
+
+        db.session.execute(Message.__table__.insert().values(text="TestMessage3", user_id=user1.id))
+        timestamp = db.session.query(Message.timestamp).filter_by(text="TestMessage3").scalar()
+        self.assertLess(abs(datetime.utcnow() - timestamp), timedelta(minutes=1))
+
+    def test_snowflake_ids(self):
+        """Snowflake ids increase with time and page feeds on their own"""
+        hashed_pwd = bcrypt.generate_password_hash("HASHED_PASSWORD").decode('UTF-8')
+        user1 = User(email="test1@test.com", username="testuser1", password=hashed_pwd)
+        db.session.add(user1)
+        db.session.commit()
+        self.assertRaises(ValueError, snowflakes.configure, enabled=True)
+        snowflakes.configure(enabled=True, worker_id=3)
+        try:
+            for i in range(5):
+                db.session.add(Message(text=f"TestMessage{i}", user_id=user1.id))
+                db.session.commit()
+            ids = [id for (id,) in db.session.query(Message.id).order_by(Message.timestamp)]
+            self.assertEqual(sorted(ids), ids)
+            self.assertLess(abs(datetime.utcnow() - id_timestamp(ids[0])), timedelta(minutes=1))
+            fresh = [snowflakes.next_id() for _ in range(1000)]
+            self.assertEqual(sorted(set(fresh)), fresh)
+            self.assertGreater(fresh[0], ids[-1])
+
+            first = Message.get_filtered_messages([user1.id], limit=3)
+            second = Message.get_filtered_messages([user1.id], before=decode_cursor(next_cursor(first, 3)), limit=3)
+            self.assertEqual(sorted(ids, reverse=True), [m.id for m in first + second])
+        finally:
+            snowflakes.configure()
+
+    def test_like_annotations(self):
+        """Timeline rows carry like counts and the viewer's liked state"""
+        hashed_pwd = bcrypt.generate_password_hash("HASHED_PASSWORD").decode('UTF-8')
+        user1 = User(email="test1@test.com", username="testuser1", password=hashed_pwd)
+        user2 = User(email="test2@test.com", username="testuser2", password=hashed_pwd)
+        db.session.add_all([user1, user2])
+        db.session.commit()
+        message1 = Message(text="TestMessage", user_id=user1.id)
+        db.session.add(message1)
+        db.session.commit()
+        Likes.add_like(user1.id, message1.id)
+        Likes.add_like(user2.id, message1.id)
+        db.session.commit()
+
+        [row] = Message.get_filtered_messages([user1.id], viewer_id=user2.id)
+        self.assertEqual((2, True), (row.like_count, bool(row.liked)))
+        Likes.delete_like(user2.id, message1.id)
+        db.session.commit()
+        [row] = Message.get_filtered_messages([user1.id], viewer_id=user2.id)
+        self.assertEqual((1, False), (row.like_count, bool(row.liked)))
+
+    def test_followed_messages(self):
+        """The feed has the viewer's own and followed users' messages, newest first"""
+        hashed_pwd = bcrypt.generate_password_hash("HASHED_PASSWORD").decode('UTF-8')
+        user1 = User(email="test1@test.com", username="testuser1", password=hashed_pwd)
+        user2 = User(email="test2@test.com", username="testuser2", password=hashed_pwd)
+        user3 = User(email="test3@test.com", username="testuser3", password=hashed_pwd)
+        db.session.add_all([user1, user2, user3])
+        db.session.commit()
+        Follows.add_follow(user1.id, user2.id)
+        messages = [Message(text=f"TestMessage{i}", user_id=user.id) for i, user in enumerate([user1, user2, user3])]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        feed = Message.get_followed_messages(user1.id)
+        self.assertEqual(sorted([messages[0].id, messages[1].id], reverse=True), [row.id for row in feed])
+        self.assertEqual([messages[1].id], [row.id for row in Message.get_followed_messages(user1.id, min_followers=0)])
+        self.assertEqual([], Message.get_followed_messages(user1.id, min_followers=1))
@@ -146,4 +146,137 @@ class MessageViewTestCase(TestCase):
             resp = c.post("/do_like", data = {"message_id":f"{message.id}"})
             after = db.session.query(Likes).count()
             self.assertEqual(before - 1, after)
-            
\ No newline at end of file
+            
+
+    def test_message_list(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Warblers sing at dawn"})
+            message = Message.query.filter_by(text="Warblers sing at dawn").one()
+
+            """Test the shared message list renders on the homepage, with its date and like button"""
+            resp = c.get("/")
+            html = resp.get_data(as_text=True)
+            self.assertIn('Warblers sing at dawn', html)
+            self.assertIn(message.timestamp.strftime('%d %B %Y'), html)
+            self.assertIn(f"doLike('#like_icon1, {message.id}')", html)
+
+            """Test compiled templates are kept in the bytecode cache"""
+            self.assertTrue(os.listdir(app.config['TEMPLATE_CACHE_DIR']))
+
+    def test_messages_search(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            """Add messages through the view so they are indexed"""
+            c.post("/messages/new", data={"text": "Warblers sing at dawn"})
+            c.post("/messages/new", data={"text": "Nothing to see here"})
+
+            """Test matching messages are found"""
+            resp = c.get("/messages/search?q=dawn")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Warblers sing at dawn', html)
+            self.assertNotIn('Nothing to see here', html)
+
+            """Test the author filter"""
+            resp = c.get(f"/messages/search?q=dawn&user={self.testuser.id + 1}")
+            self.assertNotIn('Warblers sing at dawn', resp.get_data(as_text=True))
+
+            """Test deleted messages drop out of the index"""
+            message = Message.query.filter_by(text="Warblers sing at dawn").one()
+            c.post(f"/messages/{message.id}/delete")
+            resp = c.get("/messages/search?q=dawn")
+            self.assertNotIn('Warblers sing at dawn', resp.get_data(as_text=True))
+
+    def test_like_verbs(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            message = Message(text="TestMessage1", user_id=self.testuser.id)
+            db.session.add(message)
+            db.session.commit()
+            message_id = message.id
+
+            """Test liking twice leaves one like"""
+            c.post(f"/messages/{message_id}/like")
+            resp = c.post(f"/messages/{message_id}/like")
+            self.assertEqual({"message_id": message_id, "liked": True}, resp.get_json())
+            self.assertEqual(1, Likes.query.filter_by(message_id=message_id).count())
+
+            """Test unliking twice leaves none"""
+            c.post(f"/messages/{message_id}/unlike")
+            c.post(f"/messages/{message_id}/unlike")
+            self.assertEqual(0, Likes.query.filter_by(message_id=message_id).count())
+            self.assertEqual(0, User.query.get(self.testuser.id).likes_count)
+
+            """Test a batch of like states"""
+            resp = c.post("/likes/batch", json={"likes": {str(message_id): True}})
+            self.assertEqual({"likes": {str(message_id): True}, "skipped": []}, resp.get_json())
+            self.assertEqual(1, Likes.query.filter_by(message_id=message_id).count())
+            resp = c.post("/likes/batch", json={"likes": {"nope": True}})
+            self.assertEqual(400, resp.status_code)
+            self.assertEqual(400, c.post("/likes/batch", json={"likes": [message_id]}).status_code)
+            self.assertEqual(400, c.post("/likes/batch", json=[message_id]).status_code)
+
+            """Test the form endpoint toggles, and rejects bad ids"""
+            c.post("/do_like", data={"message_id": message_id})
+            self.assertEqual(0, Likes.query.filter_by(message_id=message_id).count())
+            c.post("/do_like", data={"message_id": message_id})
+            self.assertEqual(1, Likes.query.filter_by(message_id=message_id).count())
+            self.assertEqual(400, c.post("/do_like", data={"message_id": "nope"}).status_code)
+            self.assertEqual(400, c.post("/do_like", data={}).status_code)
+            self.assertEqual(404, c.post("/do_like", data={"message_id": message_id + 1}).status_code)
+
+            """Test messages that don't exist are skipped, not fatal"""
+            resp = c.post("/likes/batch", json={"likes": {str(message_id): False, str(message_id + 1): True}})
+            self.assertEqual({"likes": {str(message_id): False}, "skipped": [message_id + 1]}, resp.get_json())
+            self.assertEqual(404, c.post(f"/messages/{message_id + 1}/like").status_code)
+
+            """Test liking needs a login"""
+            with c.session_transaction() as sess:
+                del sess[CURR_USER_KEY]
+            resp = c.post(f"/messages/{message_id}/like")
+            self.assertEqual(401, resp.status_code)
+            self.assertEqual(401, c.post("/likes/batch", json={"likes": {}}).status_code)
+            self.assertEqual(401, c.post("/do_like", data={"message_id": message_id}).status_code)
+
+    def test_api(self):
+        user_id = self.testuser.id
+        with self.client as c:
+            """Test the timeline needs a login"""
+            resp = c.get("/api/v1/timeline")
+            self.assertEqual(401, resp.status_code)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            for text in ["First", "Second", "Third"]:
+                c.post("/messages/new", data={"text": text})
+            message_id = Message.query.filter_by(text="Second").one().id
+            c.post(f"/messages/{message_id}/like")
+
+            """Test cursor pagination of the timeline"""
+            page = c.get("/api/v1/timeline?limit=2").get_json()
+            self.assertEqual(["Third", "Second"], [m["text"] for m in page["messages"]])
+            self.assertTrue(page["messages"][1]["liked"])
+            self.assertEqual(1, page["messages"][1]["like_count"])
+            page = c.get(f"/api/v1/timeline?limit=2&before={page['next']}").get_json()
+            self.assertEqual(["First"], [m["text"] for m in page["messages"]])
+            self.assertIsNone(page["next"])
+
+            """Test profiles and single messages"""
+            data = c.get(f"/api/v1/users/{user_id}").get_json()
+            self.assertEqual("testuser", data["user"]["username"])
+            self.assertEqual(3, data["user"]["messages_count"])
+            self.assertNotIn("email", data["user"])
+            self.assertEqual(3, len(data["messages"]))
+
+            data = c.get(f"/api/v1/messages/{message_id}").get_json()
+            self.assertEqual("Second", data["message"]["text"])
+            self.assertEqual(user_id, data["message"]["user"]["id"])
+            self.assertEqual(404, c.get("/api/v1/messages/0").status_code)
@@ -0,0 +1,133 @@
+"""Timeline model tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline_model.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, Timeline
+from flask_bcrypt import Bcrypt
+
+bcrypt = Bcrypt()
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+
+# Now we can import app
+
+from app import app
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class TimelineModelTestCase(TestCase):
+    """Test materialized home timelines."""
+
+    def setUp(self):
+        """Create two users, one following the other."""
+
+        Timeline.query.delete()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        hashed_pwd = bcrypt.generate_password_hash("HASHED_PASSWORD").decode('UTF-8')
+        self.author = User(email="author@test.com", username="author", password=hashed_pwd)
+        self.reader = User(email="reader@test.com", username="reader", password=hashed_pwd)
+        db.session.add_all([self.author, self.reader])
+        db.session.commit()
+        Follows.add_follow(self.reader.id, self.author.id)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def post(self, user, text, fanout_limit=10):
+        message = Message(text=text, user_id=user.id)
+        db.session.add(message)
+        db.session.flush()
+        Timeline.fan_out(message, fanout_limit)
+        db.session.commit()
+        return message
+
+    def test_fan_out(self):
+        """Posting delivers to the author and every follower"""
+        message = self.post(self.author, "Hello")
+        self.assertEqual([message.id], [m.id for m in Timeline.get_home_messages(self.reader.id, 10)])
+        self.assertEqual([message.id], [m.id for m in Timeline.get_home_messages(self.author.id, 10)])
+
+    def test_self_follow(self):
+        """Following yourself is refused, and an old self-follow doesn't break fan-out"""
+        self.assertRaises(ValueError, Follows.add_follow, self.author.id, self.author.id)
+        db.session.add(Follows(user_following_id=self.author.id, user_being_followed_id=self.author.id))
+        db.session.commit()
+        message = self.post(self.author, "Hello")
+        self.assertEqual([message.id], [m.id for m in Timeline.get_home_messages(self.author.id, 10)])
+
+    def test_celebrity_fan_out_on_read(self):
+        """Authors above the fan-out limit are merged in at read time"""
+        message = self.post(self.author, "Hello", fanout_limit=0)
+        self.assertEqual(0, Timeline.query.filter_by(owner_id=self.reader.id).count())
+        self.assertEqual([message.id], [m.id for m in Timeline.get_home_messages(self.reader.id, 0)])
+
+    def test_backfill_and_prune(self):
+        """Following copies recent messages in, unfollowing removes them"""
+        Follows.delete_follow(self.reader.id, self.author.id)
+        db.session.commit()
+        message = self.post(self.author, "Hello")
+        self.assertEqual([], Timeline.get_home_messages(self.reader.id, 10))
+
+        Timeline.backfill(self.reader.id, self.author.id, 100)
+        db.session.commit()
+        self.assertEqual([message.id], [m.id for m in Timeline.get_home_messages(self.reader.id, 10)])
+
+        Timeline.prune(self.reader.id, self.author.id)
+        db.session.commit()
+        self.assertEqual([], Timeline.get_home_messages(self.reader.id, 10))
+
+    def test_follow_before_delivery(self):
+        """A follow backfilled between posting and delivery doesn't break fan-out"""
+        message = Message(text="Hello", user_id=self.author.id)
+        db.session.add(message)
+        db.session.commit()
+
+        hashed_pwd = bcrypt.generate_password_hash("HASHED_PASSWORD").decode('UTF-8')
+        late = User(email="late@test.com", username="late", password=hashed_pwd)
+        db.session.add(late)
+        db.session.commit()
+        Follows.add_follow(late.id, self.author.id)
+        Timeline.backfill(late.id, self.author.id, 100)
+        db.session.commit()
+
+        Timeline.fan_out(message, 10)
+        db.session.commit()
+        for user in (self.author, self.reader, late):
+            self.assertEqual([message.id], [m.id for m in Timeline.get_home_messages(user.id, 10)])
+
+    def test_rebuild(self):
+        """Rebuilding copies only each author's latest messages, and none from celebrities"""
+        messages = [self.post(self.author, f"Hello {i}") for i in range(3)]
+        User.recompute_counters()
+        db.session.commit()
+
+        Timeline.rebuild(10, 2)
+        db.session.commit()
+        self.assertEqual(3, Timeline.query.filter_by(owner_id=self.author.id).count())
+        self.assertEqual({m.id for m in messages[1:]},
+                         {t.message_id for t in Timeline.query.filter_by(owner_id=self.reader.id)})
+
+        Timeline.rebuild(0, 2)
+        db.session.commit()
+        self.assertEqual(0, Timeline.query.filter_by(owner_id=self.reader.id).count())
+        self.assertEqual(3, len(Timeline.get_home_messages(self.reader.id, 0)))
@@ -6,9 +6,11 @@
 
 
 import os
+import time
 from unittest import TestCase
 
 from models import db, User, Message, Follows, Likes
+from hashing import hasher, HashingBusy
 from flask_bcrypt import Bcrypt
 
 bcrypt = Bcrypt()
@@ -111,4 +113,140 @@ class UserModelTestCase(TestCase):
         # Does User.create fail to create a new user if any of the validations (e.g. uniqueness, non-nullable fields) fail?
         # Does User.authenticate successfully return a user when given a valid username and password?
         # Does User.authenticate fail to return a user when the username is invalid?
-        # Does User.authenticate fail to return a user when the password is invalid?
\ No newline at end of file
+        # Does User.authenticate fail to return a user when the password is invalid?
+
+    def test_counters(self):
+        """Are the denormalized counters kept in sync and repairable?"""
+        hashed_pwd = bcrypt.generate_password_hash("HASHED_PASSWORD").decode('UTF-8')
+        user1 = User(email="test1@test.com", username="testuser1", password=hashed_pwd)
+        user2 = User(email="test2@test.com", username="testuser2", password=hashed_pwd)
+        db.session.add_all([user1, user2])
+        db.session.commit()
+
+        Follows.add_follow(user1.id, user2.id)
+        message = Message(text="TestMessage", user_id=user2.id)
+        db.session.add(message)
+        User.adjust_counters(user2.id, messages_count=1)
+        db.session.commit()
+        Likes.add_like(user1.id, message.id)
+        db.session.commit()
+        self.assertEqual((1, 1), (user1.following_count, user1.likes_count))
+        self.assertEqual((1, 1), (user2.followers_count, user2.messages_count))
+
+        """Test counters are repaired from the underlying tables"""
+        User.query.update({User.likes_count: 7, User.followers_count: 7})
+        User.recompute_counters()
+        db.session.commit()
+        self.assertEqual((1, 1), (user1.following_count, user1.likes_count))
+        self.assertEqual((1, 0), (user2.followers_count, user2.likes_count))
+
+        """Test deleting a message releases its likes"""
+        Message.delete_message(message.id)
+        db.session.commit()
+        self.assertEqual((0, 0), (user1.likes_count, user2.messages_count))
+
+        """Test deleting a user releases their follows"""
+        User.release_counters(user2.id)
+        db.session.commit()
+        self.assertEqual(0, user1.following_count)
+
+        """Test deleting a user changes the authors they liked"""
+        Follows.query.delete()
+        message = Message(text="TestMessage", user_id=user2.id)
+        db.session.add(message)
+        db.session.commit()
+        Likes.add_like(user1.id, message.id)
+        db.session.commit()
+        version = user2.version
+        User.release_counters(user1.id)
+        db.session.commit()
+        db.session.refresh(user2)
+        self.assertGreater(user2.version, version)
+
+    def test_delete_cascades(self):
+        """Does deleting a user leave their rows to the database's cascades?"""
+        hashed_pwd = bcrypt.generate_password_hash("HASHED_PASSWORD").decode('UTF-8')
+        user1 = User(email="test1@test.com", username="testuser1", password=hashed_pwd)
+        user2 = User(email="test2@test.com", username="testuser2", password=hashed_pwd)
+        db.session.add_all([user1, user2])
+        db.session.commit()
+
+        Follows.add_follow(user1.id, user2.id)
+        Follows.add_follow(user2.id, user1.id)
+        message = Message(text="TestMessage", user_id=user2.id)
+        db.session.add(message)
+        db.session.commit()
+        Likes.add_like(user1.id, message.id)
+        db.session.commit()
+
+        db.session.delete(user2)
+        db.session.commit()
+        self.assertEqual(0, Message.query.count())
+        self.assertEqual(0, Follows.query.count())
+        self.assertEqual(0, Likes.query.count())
+
+    def test_rehash_on_login(self):
+        """Does logging in upgrade a hash made with an old work factor?"""
+        old_pwd = bcrypt.generate_password_hash("HASHED_PASSWORD1", 4).decode('UTF-8')
+        user1 = User(email="test1@test.com", username="testuser1", password=old_pwd)
+        db.session.add(user1)
+        db.session.commit()
+
+        self.assertTrue(hasher.needs_rehash(user1.password))
+        self.assertEqual(user1, User.authenticate("testuser1", "HASHED_PASSWORD1"))
+        self.assertFalse(hasher.needs_rehash(user1.password))
+        self.assertEqual(user1, User.authenticate("testuser1", "HASHED_PASSWORD1"))
+
+    def test_hashing_backpressure(self):
+        """Are hashes rejected once the queue is full?"""
+        rounds = hasher.rounds
+        hasher.configure(rounds=4, workers=1, max_pending=0)
+        try:
+            with self.assertRaises(HashingBusy):
+                hasher.hash("HASHED_PASSWORD1")
+            self.assertGreater(hasher.metrics.rejected, 0)
+        finally:
+            hasher.configure(rounds=rounds, workers=app.config['HASH_WORKERS'],
+                             max_pending=app.config['HASH_MAX_PENDING'])
+
+    def test_hashing_timeout(self):
+        """Does a slow hash answer busy, and keep its slot until bcrypt is done?"""
+        rounds = hasher.rounds
+        hasher.configure(rounds=12, workers=1, max_pending=1, timeout=0.001)
+        try:
+            with self.assertRaises(HashingBusy):
+                hasher.hash("HASHED_PASSWORD1")
+            rejected = hasher.metrics.rejected
+            with self.assertRaises(HashingBusy):
+                hasher.hash("HASHED_PASSWORD1")
+            self.assertEqual(rejected + 1, hasher.metrics.rejected)
+
+            for _ in range(500):
+                if not hasher.pending:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(0, hasher.pending)
+        finally:
+            hasher.configure(rounds=rounds, workers=app.config['HASH_WORKERS'],
+                             max_pending=app.config['HASH_MAX_PENDING'])
+
+    def test_search(self):
+        """Does search rank exact, then prefix, then substring matches?"""
+        hashed_pwd = bcrypt.generate_password_hash("HASHED_PASSWORD").decode('UTF-8')
+        for username in ["busam", "samantha", "sam", "bob"]:
+            db.session.add(User(email=f"{username}@test.com", username=username, password=hashed_pwd))
+        db.session.commit()
+
+        users, has_more = User.search("sam")
+        self.assertEqual(["sam", "samantha", "busam"], [u.username for u in users])
+        self.assertFalse(has_more)
+
+        """Test search results are paginated"""
+        users, has_more = User.search("sam", page=1, per_page=2)
+        self.assertEqual(["sam", "samantha"], [u.username for u in users])
+        self.assertTrue(has_more)
+        users, has_more = User.search("sam", page=2, per_page=2)
+        self.assertEqual(["busam"], [u.username for u in users])
+
+        """Test LIKE wildcards are matched literally"""
+        self.assertEqual([], User.search("%")[0])
@@ -8,7 +8,8 @@
 import os
 from unittest import TestCase
 # from flask import g
-from models import db, connect_db, Message, User, Likes
+from sqlalchemy import event
+from models import db, connect_db, Message, User, Likes, Timeline
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -20,7 +21,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY, g
+from app import app, CURR_USER_KEY, g, user_cache, fragment_cache
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -39,6 +40,9 @@ class UserViewTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
 
+        # Cached rows and fragments from other tests would outlive their users.
+        user_cache.clear()
+        fragment_cache.clear()
         User.query.delete()
         Message.query.delete()
 
@@ -54,6 +58,8 @@ class UserViewTestCase(TestCase):
         
     def tearDown(self):
         db.session.rollback()
+        user_cache.clear()
+        fragment_cache.clear()
         
     def test_add_user_to_g(self):
         with self.client as c:
@@ -196,9 +202,10 @@ class UserViewTestCase(TestCase):
             user.followers.append(self.testuser)
             db.session.commit()   
             before = len(self.testuser.following)
+            testid = self.testuser.id
             resp = c.post(f"/users/stop-following/{user.id}", follow_redirects=True)
             self.assertEqual(resp.status_code, 200)
-            newuser = db.session.query(User).filter_by(id=self.testuser.id).first()
+            newuser = db.session.query(User).filter_by(id=testid).first()
             after = len(newuser.following)        
             self.assertEqual(before -1, after)
             
@@ -244,6 +251,21 @@ class UserViewTestCase(TestCase):
             testuser = db.session.query(User).filter_by(id=g.user.id).first()
             self.assertEqual("Earth", testuser.location)
             
+    def test_profile_cache(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            """Test g.user is served from the cache once loaded"""
+            c.get("/")
+            self.assertIsNone(g.user.location)
+
+            """Test updating the profile invalidates the cached copy"""
+            d = {"password":"testuser", "email":"test@test.com", "location":"Mars"}
+            c.post("users/profile", data=d)
+            c.get("/")
+            self.assertEqual("Mars", g.user.location)
+
     def test_changepw(self):
         with self.client as c:
             with c.session_transaction() as sess:
@@ -276,4 +298,145 @@ class UserViewTestCase(TestCase):
             self.assertIsNone(userg)
             """Test if user is deleted"""
             deleted = db.session.query(User).filter_by(id=testid).first()
-            self.assertIsNone(deleted)
\ No newline at end of file
+            self.assertIsNone(deleted)
+
+    def count_statements(self, client, url):
+        """Number of SQL statements run while rendering `url`."""
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            resp = client.get(url)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(resp.status_code, 200)
+        return len(statements)
+
+    def add_authors(self, count):
+        """Create `count` users followed by testuser, each with a message."""
+        for i in range(count):
+            author = User.signup(username=f"author{i}{User.query.count()}",
+                                 email=f"author{i}{User.query.count()}@test.com",
+                                 password="authorpw",
+                                 image_url=None)
+            db.session.commit()
+            author.followers.append(self.testuser)
+            message = Message(text=f"Message from {author.username}", user_id=author.id)
+            db.session.add(message)
+            db.session.flush()
+            Timeline.fan_out(message, app.config['TIMELINE_FANOUT_LIMIT'])
+            db.session.commit()
+
+    def test_timeline_statement_count(self):
+        """Rendering a timeline costs the same number of queries for any number of authors"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            self.add_authors(1)
+            c.get("/")
+            few = self.count_statements(c, "/")
+            self.add_authors(4)
+            many = self.count_statements(c, "/")
+            self.assertEqual(few, many)
+
+    def test_profile_etag(self):
+        """Test profile pages answer conditional GETs until the user changes"""
+        with self.client as c:
+            resp = c.get(f"/users/{self.testuser.id}")
+            etag = resp.headers["ETag"]
+            self.assertTrue(etag.startswith('W/'))
+            self.assertIn("public", resp.headers["Cache-Control"])
+
+            resp = c.get(f"/users/{self.testuser.id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            User.adjust_counters(self.testuser.id, messages_count=1)
+            db.session.commit()
+            resp = c.get(f"/users/{self.testuser.id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(etag, resp.headers["ETag"])
+
+            """Test a new build changes every ETag"""
+            etag = resp.headers["ETag"]
+            app.config['BUILD_VERSION'] = "next"
+            try:
+                resp = c.get(f"/users/{self.testuser.id}", headers={"If-None-Match": etag})
+            finally:
+                app.config['BUILD_VERSION'] = None
+            self.assertEqual(resp.status_code, 200)
+
+            """Test pages are personalized per viewer"""
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            resp = c.get(f"/users/{self.testuser.id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("private", resp.headers["Cache-Control"])
+
+    def test_static_url(self):
+        """Test static files are linked by content hash and cached for good"""
+        with self.client as c:
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn('/static/js/app.js?v=', html)
+            resp = c.get('/static/js/app.js?v=1')
+            self.assertIn("immutable", resp.headers["Cache-Control"])
+            resp.close()
+
+    def test_replica_routing(self):
+        """Test GETs read from the replica until a POST pins the session to the primary"""
+        app.config['SQLALCHEMY_BINDS'] = {'replica': app.config['SQLALCHEMY_DATABASE_URI']}
+        replica = db.get_engine(app, bind='replica')
+        engines = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            engines.append(conn.engine)
+        event.listen(replica, 'before_cursor_execute', record)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                c.get(f"/users/{self.testuser.id}")
+                self.assertEqual({replica}, set(engines))
+
+                engines.clear()
+                c.post("/messages/new", data={"text": "Hello"})
+                self.assertEqual({db.engine}, set(engines))
+
+                engines.clear()
+                c.get(f"/users/{g.user.id}")
+                self.assertEqual({db.engine}, set(engines))
+        finally:
+            event.remove(replica, 'before_cursor_execute', record)
+            event.remove(db.engine, 'before_cursor_execute', record)
+            app.config['SQLALCHEMY_BINDS'] = {}
+
+    def test_instrumentation(self):
+        """Test per-request costs are reported in headers, logs and /_metrics"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            with self.assertLogs('warbler.requests', level='INFO') as logs:
+                resp = c.get(f"/users/{self.testuser.id}")
+            self.assertIn('db;dur=', resp.headers["Server-Timing"])
+            self.assertIn('"endpoint": "users_show"', logs.output[-1])
+
+            resp = c.get("/_metrics")
+            self.assertIn('warbler_requests_total{endpoint="users_show",status="200"}',
+                          resp.get_data(as_text=True))
+
+            """Test slow statements are logged with their plan"""
+            app.config['SLOW_QUERY_MS'] = 0
+            try:
+                with self.assertLogs('warbler.slow_queries') as logs:
+                    c.get(f"/users/{self.testuser.id}")
+            finally:
+                app.config['SLOW_QUERY_MS'] = 200
+            self.assertIn('"plan": "', logs.output[0])
+
+            """Test failed statements don't leave their start times behind"""
+            with db.engine.connect() as connection:
+                self.assertRaises(Exception, connection.execute, "SELECT * FROM no_such_table")
+                self.assertEqual([], connection.info['statement_start'])